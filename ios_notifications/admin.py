@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from django.contrib import admin
-from ios_notifications.models import Device, Notification, APNService, FeedbackService
+from ios_notifications.models import Device, Notification, APNService, FeedbackService, NotificationJob
 from ios_notifications.forms import APNServiceForm
 from django.conf.urls.defaults import patterns, url
 from django.template.response import TemplateResponse
 from django.shortcuts import get_object_or_404
+from django.conf import settings
 
 
 class APNServiceAdmin(admin.ModelAdmin):
@@ -20,7 +21,7 @@ class DeviceAdmin(admin.ModelAdmin):
 
 class NotificationAdmin(admin.ModelAdmin):
     exclude = ('last_sent_at',)
-    list_display = ('message', 'badge', 'sound', 'created_at', 'last_sent_at')
+    list_display = ('message', 'badge', 'sound', 'created_at', 'send_at', 'last_sent_at')
 
     def get_urls(self):
         urls = super(NotificationAdmin, self).get_urls()
@@ -32,15 +33,26 @@ class NotificationAdmin(admin.ModelAdmin):
     def admin_push_notification(self, request, **kwargs):
         notification = get_object_or_404(Notification, **kwargs)
         num_devices = 0
+        queued = getattr(settings, 'IOS_NOTIFICATIONS_QUEUE_ADMIN_PUSHES', False)
         if request.method == 'POST':
             service = notification.service
             num_devices = service.device_set.filter(is_active=True).count()
-            notification.service.push_notification_to_devices(notification)
+            if queued:
+                notification.enqueue()
+            else:
+                notification.service.push_notification_to_devices(notification)
         return TemplateResponse(request, 'admin/ios_notifications/notification/push_notification.html',
-                                {'notification': notification, 'num_devices': num_devices, 'sent': request.method == 'POST'},
+                                {'notification': notification, 'num_devices': num_devices, 'sent': request.method == 'POST',
+                                 'queued': queued},
                                 current_app='ios_notifications')
 
+
+class NotificationJobAdmin(admin.ModelAdmin):
+    list_display = ('notification', 'status', 'cursor', 'attempts', 'created_at', 'claimed_at', 'finished_at')
+    list_filter = ('status',)
+
 admin.site.register(Device, DeviceAdmin)
 admin.site.register(Notification, NotificationAdmin)
 admin.site.register(APNService, APNServiceAdmin)
 admin.site.register(FeedbackService)
+admin.site.register(NotificationJob, NotificationJobAdmin)
@@ -5,12 +5,15 @@ from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
 from django.db import IntegrityError
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.utils.decorators import method_decorator
 
-from ios_notifications.models import Device
-from ios_notifications.forms import DeviceForm
+from ios_notifications.models import APNService, Device
+from ios_notifications.forms import DeviceRegistrationForm
 from ios_notifications.decorators import api_authentication_required
 from ios_notifications.http import HttpResponseNotImplemented, JSONResponse
+from ios_notifications.fields import normalize_token, is_valid_token
+from ios_notifications import registration
 
 
 class BaseResource(object):
@@ -50,28 +53,39 @@ class DeviceResource(BaseResource):
 
         If the device does not exist a 404 will be raised.
         """
-        device = get_object_or_404(Device, **kwargs)
+        device = get_object_or_404(Device.objects.filter_token(kwargs.pop('token')), **kwargs)
         return JSONResponse(device)
 
     def post(self, request, **kwargs):
         """
         Creates a new device or updates an existing one to `is_active=True`.
         Expects two non-options POST parameters: `token` and `service`.
+
+        With IOS_NOTIFICATIONS_REGISTRATION_WRITE_BEHIND devices which have already
+        been registered by this process are answered from memory and written later.
+        They were validated when they were first registered, so the form isn't used.
         """
-        devices = Device.objects.filter(token=request.POST.get('token'),
-                                        service__id=int(request.POST.get('service', 0)))
-        if devices.exists():
-            device = devices.get()
-            device.is_active = True
-            device.save()
-            return JSONResponse(device)
-        form = DeviceForm(request.POST)
-        if form.is_valid():
-            device = form.save(commit=False)
-            device.is_active = True
-            device.save()
-            return JSONResponse(device, status=201)
-        return JSONResponse(form.errors, status=400)
+        if registration.WRITE_BEHIND:
+            try:
+                service_id = int(request.POST.get('service', ''))
+            except ValueError:
+                service_id = None
+            cached = registration.registration_buffer.confirm(normalize_token(request.POST.get('token', '')),
+                                                              service_id)
+            if cached is not None:
+                return JSONResponse(cached)
+        form = DeviceRegistrationForm(request.POST)
+        if not form.is_valid():
+            return JSONResponse(form.errors, status=400)
+        data = form.cleaned_data
+        fields = dict((key, data[key]) for key in ('platform', 'display', 'os_version') if data[key])
+        try:
+            device, created = Device.objects.register(data['token'], data['service'], **fields)
+        except (IntegrityError, Device.DoesNotExist):
+            return JSONResponse({'service': ['APNService with id %d does not exist' % data['service']]}, status=400)
+        if registration.WRITE_BEHIND:
+            registration.registration_buffer.add(device)
+        return JSONResponse(device, status=201 if created else 200)
 
     def put(self, request, **kwargs):
         """
@@ -86,11 +100,17 @@ class DeviceResource(BaseResource):
         body of any HTTP PUT request.
         """
         try:
-            device = Device.objects.get(**kwargs)
+            device = Device.objects.filter_token(kwargs['token']).get(service__id=kwargs['service__id'])
         except Device.DoesNotExist:
             return JSONResponse({'error': 'Device with token %s and service %s does not exist' %
                                 (kwargs['token'], kwargs['service__id'])}, status=400)
 
+        # A registration still waiting to be written is applied first, so it can't undo this update.
+        registered_at = registration.registration_buffer.discard(device)
+        if registered_at is not None:
+            device.is_active = True
+            device.last_registered_at = registered_at
+
         if 'users' in request.PUT:
             try:
                 user_ids = request.PUT.getlist('users')
@@ -107,11 +127,54 @@ class DeviceResource(BaseResource):
         return JSONResponse(device)
 
 
+class BulkDeviceResource(BaseResource):
+    """
+    The API resource for registering many devices of one service in a single request.
+
+    Allowed HTTP methods are POST.
+    """
+    allowed_methods = ('POST',)
+
+    def post(self, request, **kwargs):
+        """
+        Creates or reactivates a device for every `token` POST parameter.
+        Expects the `service` POST parameter and one or more `token` parameters.
+
+        Responds with the number of devices created and reactivated.
+        """
+        tokens = request.POST.getlist('token')
+        try:
+            service_id = int(request.POST.get('service', 0))
+        except ValueError:
+            service_id = 0
+        errors = {}
+        if service_id < 1:
+            errors['service'] = ['A valid service id is required']
+        limit = getattr(settings, 'IOS_NOTIFICATIONS_BULK_REGISTRATION_LIMIT', 1000)
+        if not tokens or len(tokens) > limit:
+            errors['token'] = ['Between 1 and %d tokens are required' % limit]
+        else:
+            tokens = [normalize_token(token) for token in tokens]
+            if not all(is_valid_token(token) for token in tokens):
+                errors['token'] = ['Device tokens must be 64 hexadecimal characters']
+        if 'service' not in errors and not APNService.objects.filter(pk=service_id).exists():
+            errors['service'] = ['APNService with id %d does not exist' % service_id]
+        if errors:
+            return JSONResponse(errors, status=400)
+        try:
+            registered = Device.objects.register_many(tokens, service_id)
+        except (IntegrityError, Device.DoesNotExist):
+            return JSONResponse({'service': ['APNService with id %d does not exist' % service_id]}, status=400)
+        created = len([device for device, is_new in registered if is_new])
+        return JSONResponse({'created': created, 'activated': len(registered) - created})
+
+
 class Router(object):
     """
     A simple class for handling URL routes.
     """
     def __init__(self):
         self.device = DeviceResource().route
+        self.bulk_device = BulkDeviceResource().route
 
 routes = Router()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import atexit
+import hashlib
+import select
+import threading
+import time
+
+from django.conf import settings
+
+import OpenSSL
+
+
+class ConnectionPool(object):
+    """
+    A process wide pool of open SSL connections keyed by service id.
+
+    Connections are checked out with `acquire` and handed back with `release`
+    so that the TLS handshake with Apple only has to be done once rather than
+    for every push. Idle connections are health checked before being reused
+    and a new connection is made if the old one has gone stale.
+    """
+    def __init__(self, max_size=10, max_idle=300):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, service):
+        """
+        Sets `service.connection` to a healthy pooled connection if one is
+        available, otherwise connects the service.
+
+        returns bool
+        """
+        key = service.pk
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                connection, released_at = idle.pop()
+            if time.time() - released_at < self.max_idle and self.is_healthy(connection):
+                service.connection = connection
+                return True
+            self._close(connection)
+        return service.connect()
+
+    def release(self, service):
+        """
+        Returns the service's connection to the pool.
+        The oldest idle connections are closed if the pool is full.
+        """
+        connection = service.connection
+        if connection is None:
+            return
+        service.connection = None
+        with self._lock:
+            self._idle.setdefault(service.pk, []).append((connection, time.time()))
+            evicted = self._evict()
+        for connection in evicted:
+            self._close(connection)
+
+    def discard(self, service):
+        """
+        Closes the service's connection without returning it to the pool.
+        """
+        if service.connection is not None:
+            self._close(service.connection)
+            service.connection = None
+
+    def clear(self, service):
+        """
+        Closes the idle connections for a single service,
+        for example after its certificate has been changed.
+        """
+        with self._lock:
+            idle = self._idle.pop(service.pk, [])
+        for connection, released_at in idle:
+            self._close(connection)
+
+    def close_all(self):
+        """
+        Closes every idle connection in the pool.
+        Should be called when shutting down a long running process.
+        """
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c, released_at in idle]
+            self._idle = {}
+        for connection in connections:
+            self._close(connection)
+
+    def idle_count(self, service=None):
+        with self._lock:
+            if service is not None:
+                return len(self._idle.get(service.pk, []))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def is_healthy(self, connection):
+        """
+        An idle APNs connection should have nothing to read.
+        If there is application data waiting Apple has sent an error response,
+        and if the socket has been closed the connection cannot be reused.
+        """
+        try:
+            readable, writable, errored = select.select([connection], [], [connection], 0)
+        except (select.error, ValueError, TypeError):
+            return False
+        if errored:
+            return False
+        if not readable:
+            return True
+        # The socket may only be readable because of TLS records such as
+        # session tickets, in which case reading yields no application data.
+        connection.setblocking(False)
+        try:
+            connection.recv(1)
+        except OpenSSL.SSL.WantReadError:
+            return True
+        except Exception:
+            return False
+        finally:
+            try:
+                connection.setblocking(True)
+            except Exception:
+                pass
+        return False
+
+    def _evict(self):
+        entries = [(released_at, key, connection) for key, idle in self._idle.items()
+                   for connection, released_at in idle]
+        if len(entries) <= self.max_size:
+            return []
+        entries.sort()
+        evicted = []
+        for released_at, key, connection in entries[:len(entries) - self.max_size]:
+            self._idle[key].remove((connection, released_at))
+            if not self._idle[key]:
+                del self._idle[key]
+            evicted.append(connection)
+        return evicted
+
+    def _close(self, connection):
+        try:
+            connection.shutdown()
+            connection.close()
+        except Exception:
+            pass
+
+
+class ContextCache(object):
+    """
+    A process wide cache of SSL contexts keyed by service.
+
+    Loading the certificate and decrypting the private key is done once per
+    service rather than on every connect. Each entry is stored with a
+    fingerprint of the credentials it was built from so that a context is
+    rebuilt as soon as the certificate, key or passphrase change.
+
+    The last TLS session for each host is kept as well so that reconnecting
+    can resume the session instead of doing a full handshake.
+    """
+    def __init__(self):
+        self._contexts = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(certificate, private_key, passphrase=None):
+        digest = hashlib.sha1()
+        for value in (certificate, private_key, passphrase or ''):
+            digest.update(value.encode('utf-8') if isinstance(value, unicode) else value)
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def get(self, key, fingerprint, factory):
+        """
+        Returns the context cached for `key`, calling `factory` to build a
+        new one if there isn't one for the credentials `fingerprint`.
+        """
+        with self._lock:
+            cached = self._contexts.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        context = factory()
+        with self._lock:
+            self._contexts[key] = (fingerprint, context)
+            for session_key in [k for k in self._sessions if k[0] == key]:
+                del self._sessions[session_key]
+        return context
+
+    def get_session(self, key, address):
+        with self._lock:
+            return self._sessions.get((key, address))
+
+    def set_session(self, key, address, session):
+        with self._lock:
+            if key in self._contexts:
+                self._sessions[(key, address)] = session
+
+    def invalidate(self, key):
+        """
+        Forgets the context and sessions cached for `key`.
+        """
+        with self._lock:
+            self._contexts.pop(key, None)
+            for session_key in [k for k in self._sessions if k[0] == key]:
+                del self._sessions[session_key]
+
+    def clear(self):
+        with self._lock:
+            self._contexts = {}
+            self._sessions = {}
+
+
+context_cache = ContextCache()
+connection_pool = ConnectionPool(getattr(settings, 'IOS_NOTIFICATIONS_CONNECTION_POOL_SIZE', 10),
+                                 getattr(settings, 'IOS_NOTIFICATIONS_CONNECTION_MAX_IDLE', 300))
+atexit.register(connection_pool.close_all)
@@ -1,7 +1,17 @@
 from django.contrib.auth import authenticate
 from ios_notifications.http import JSONResponse
 from django.conf import settings
+from django.utils.encoding import smart_str
 import binascii
+import hashlib
+import hmac
+import threading
+import time
+
+try:
+    from django.test.signals import setting_changed
+except ImportError:  # Django < 1.4
+    setting_changed = None
 
 
 class InvalidAuthenticationType(Exception):
@@ -9,7 +19,97 @@ class InvalidAuthenticationType(Exception):
 
 
 # TODO: OAuth
-VALID_AUTH_TYPES = ('AuthBasic', 'AuthBasicIsStaff', 'AuthNone')
+VALID_AUTH_TYPES = ('AuthBasic', 'AuthBasicIsStaff', 'AuthToken', 'AuthNone')
+
+
+def keyed_hash(value):
+    """
+    Hashes `value` with a key derived from SECRET_KEY so that credentials
+    are never kept in memory in a form which could be used to log in.
+    """
+    return hmac.new(smart_str(settings.SECRET_KEY), smart_str(value), hashlib.sha256).hexdigest()
+
+
+class AuthCache(object):
+    """
+    A bounded cache of successful Basic authentications keyed by a keyed hash of
+    the Authorization header, so the password doesn't have to be hashed again on
+    every request from the same client.
+
+    Entries expire after `ttl` seconds. When the cache holds `max_size` entries
+    the least recently used tenth of them are removed.
+    """
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        returns whether the cached user is staff, or None if the key isn't cached.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            is_staff, expires, last_used = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            self._entries[key] = (is_staff, expires, now)
+            return is_staff
+
+    def set(self, key, is_staff):
+        if self.max_size <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                self._evict(now)
+            self._entries[key] = (is_staff, now + self.ttl, now)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        expired = [key for key, entry in self._entries.items() if entry[1] <= now]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) < self.max_size:
+            return
+        by_use = sorted(self._entries.items(), key=lambda item: item[1][2])
+        for key, entry in by_use[:max(self.max_size // 10, 1)]:
+            del self._entries[key]
+
+
+AUTH_TYPE = None
+API_TOKENS = frozenset()
+auth_cache = AuthCache(0)
+
+
+def load_settings(**kwargs):
+    """
+    Reads the authentication settings. They are read once when the module is
+    imported and again whenever a test changes one of them with override_settings.
+    """
+    global AUTH_TYPE, API_TOKENS, auth_cache
+    setting = kwargs.get('setting')
+    if setting is not None and setting != 'SECRET_KEY' and not setting.startswith('IOS_NOTIFICATIONS_'):
+        return
+    AUTH_TYPE = getattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', None)
+    API_TOKENS = frozenset(keyed_hash(token) for token in getattr(settings, 'IOS_NOTIFICATIONS_API_TOKENS', ()))
+    auth_cache = AuthCache(getattr(settings, 'IOS_NOTIFICATIONS_AUTH_CACHE_SIZE', 0),
+                           getattr(settings, 'IOS_NOTIFICATIONS_AUTH_CACHE_TTL', 300))
+
+load_settings()
+if setting_changed is not None:
+    setting_changed.connect(load_settings)
 
 
 def api_authentication_required(func):
@@ -18,14 +118,20 @@ def api_authentication_required(func):
     and authenticate the request user appropriately.
     """
     def wrapper(request, *args, **kwargs):
-        AUTH_TYPE = getattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', None)
         if AUTH_TYPE is None or AUTH_TYPE not in VALID_AUTH_TYPES:
             raise InvalidAuthenticationType('IOS_NOTIFICATIONS_AUTHENTICATION must be specified in your settings.py file.\
-                    Valid options are "AuthBasic", "AuthBasicIsStaff" or "AuthNone"')
+                    Valid options are "AuthBasic", "AuthBasicIsStaff", "AuthToken" or "AuthNone"')
         # Basic Authorization
         elif AUTH_TYPE == 'AuthBasic' or AUTH_TYPE == 'AuthBasicIsStaff':
             if 'HTTP_AUTHORIZATION' in request.META:
-                auth_type, encoded_user_password = request.META['HTTP_AUTHORIZATION'].split(' ')
+                header = request.META['HTTP_AUTHORIZATION']
+                key = keyed_hash(header)
+                is_staff = auth_cache.get(key)
+                if is_staff is not None:
+                    if AUTH_TYPE == 'AuthBasic' or is_staff:
+                        return func(request, *args, **kwargs)
+                    return JSONResponse({'error': 'authentication error'}, status=401)
+                auth_type, encoded_user_password = header.split(' ')
                 try:
                     userpass = encoded_user_password.decode('base64')
                 except binascii.Error:
@@ -36,11 +142,24 @@ def api_authentication_required(func):
                     return JSONResponse({'error': 'malformed Authorization header'}, status=401)
                 user = authenticate(username=username, password=password)
                 if user is not None:
+                    auth_cache.set(key, user.is_staff)
                     if AUTH_TYPE == 'AuthBasic' or user.is_staff:
                         return func(request, *args, **kwargs)
                 return JSONResponse({'error': 'authentication error'}, status=401)
             return JSONResponse({'error': 'Authorization header not set'}, status=401)
 
+        # Token Authorization: an API token from IOS_NOTIFICATIONS_API_TOKENS
+        elif AUTH_TYPE == 'AuthToken':
+            if 'HTTP_AUTHORIZATION' in request.META:
+                try:
+                    auth_type, token = request.META['HTTP_AUTHORIZATION'].split(' ')
+                except ValueError:
+                    return JSONResponse({'error': 'malformed Authorization header'}, status=401)
+                if auth_type == 'Token' and keyed_hash(token) in API_TOKENS:
+                    return func(request, *args, **kwargs)
+                return JSONResponse({'error': 'authentication error'}, status=401)
+            return JSONResponse({'error': 'Authorization header not set'}, status=401)
+
         # AuthNone: No authorization.
         return func(request, *args, **kwargs)
     return wrapper
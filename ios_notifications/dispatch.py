@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+
+from ios_notifications.frames import PushResult
+from ios_notifications.models import APNService, Device, Notification, DeliveryTracker, PackedRows
+
+
+class DispatchResult(dict):
+    """
+    The result of a dispatch: a dict mapping each APNService sent to the
+    ios_notifications.frames.PushResult of its push, or None if the service
+    could not be connected to.
+    """
+    @property
+    def total(self):
+        """
+        A PushResult adding up the pushes to every service which could be connected to.
+        """
+        total = PushResult()
+        started = [result.started_at for result in self.values() if result is not None]
+        if started:
+            total.started_at = min(started)
+        for result in self.values():
+            if result is not None:
+                total.merge(result)
+        return total.finish()
+
+
+class ServicePush(threading.Thread):
+    """
+    Writes a notification to a group of devices of one service over a pooled
+    connection. The database is left to the dispatching thread.
+    """
+    def __init__(self, service, notification, rows, tracker, enhanced=None, expiry=None):
+        super(ServicePush, self).__init__()
+        self.daemon = True
+        self.service = service
+        self.notification = notification
+        self.rows = rows
+        self.tracker = tracker
+        self.enhanced = enhanced
+        self.expiry = expiry
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.service._push(self.notification, PackedRows(self.rows), self.enhanced, self.expiry,
+                                             self.tracker)
+        except Exception as e:
+            self.error = e
+
+
+def copy_notification(notification, service):
+    """
+    Returns a notification for `service` with the same content as `notification`.
+
+    An earlier notification of the service with the same content is reused, so
+    dispatching the same message again and again doesn't add a notification for
+    every service each time. Notifications scheduled with `send_at` are left alone.
+    """
+    excluded = ('service', 'created_at', 'last_sent_at', 'send_at')
+    fields = dict((field.attname, getattr(notification, field.attname)) for field in Notification._meta.local_fields
+                  if not field.primary_key and field.name not in excluded)
+    copies = Notification.objects.filter(service=service, send_at__isnull=True, **fields).order_by('-id')[:1]
+    if copies:
+        return copies[0]
+    return Notification.objects.create(service=service, **fields)
+
+
+def dispatch(notification, devices=None, user_ids=None, enhanced=None, expiry=None):
+    """
+    Sends a notification to devices of any number of APN Services at once,
+    for example the sandbox, production and white label versions of an app.
+
+    `devices` is a Device QuerySet and defaults to every active device. `user_ids`
+    optionally limits it to the devices of those users. The devices are read and
+    grouped by service with one query, with each device token sent at most once
+    per service, and every group is sent in its own thread over a pooled connection.
+
+    `notification` provides the content. Each service is sent its own copy, saved
+    with the service, unless `notification` already belongs to it. Copies are
+    reused by later dispatches of the same content, see `copy_notification`.
+
+    returns a DispatchResult of the PushResult for each service.
+    """
+    if devices is None:
+        devices = Device.objects.filter(is_active=True)
+    if user_ids is not None:
+        devices = devices.filter(users__id__in=list(user_ids))
+    rows = devices.filter(token_bin__isnull=False).order_by('service', 'id') \
+                  .values_list('service', 'id', 'token_bin').distinct()
+
+    groups = {}
+    order = []
+    seen = set()
+    for service_id, pk, token in rows:
+        token = str(token)
+        if (service_id, token) in seen:
+            continue
+        seen.add((service_id, token))
+        if service_id not in groups:
+            groups[service_id] = []
+            order.append(service_id)
+        groups[service_id].append((pk, token))
+
+    result = DispatchResult()
+    if not order:
+        return result
+    services = APNService.objects.in_bulk(order)
+    tracker = DeliveryTracker(autoflush=False)
+    threads = []
+    for service_id in order:
+        service = services[service_id]
+        if notification.pk is not None and notification.service_id == service_id:
+            copy = notification
+        else:
+            copy = copy_notification(notification, service)
+        threads.append(ServicePush(service, copy, groups[service_id], tracker, enhanced, expiry))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracker.flush()
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+        result[thread.service] = thread.result
+        if thread.result is not None:
+            thread.notification.last_sent_at = datetime.datetime.now()
+            thread.notification.save()
+    return result
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import re
+from binascii import hexlify, unhexlify
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+TOKEN_LENGTH = 32
+TOKEN_RE = re.compile(r'^[0-9a-f]{64}\Z')
+# Spaces and angle brackets appear when a token is copied from the description of an NSData.
+TOKEN_NOISE_RE = re.compile(r'[\s<>]')
+
+
+def normalize_token(token):
+    """
+    Strips spaces and angle brackets from a device token and lowercases it,
+    e.g. '<A1B2C3D4 ...>' becomes 'a1b2c3d4...'.
+    """
+    if not isinstance(token, basestring):
+        return token
+    return TOKEN_NOISE_RE.sub('', token).lower()
+
+
+def is_valid_token(token):
+    """
+    Determines if `token` is a normalized device token of 64 lowercase hexadecimal characters.
+    """
+    return isinstance(token, basestring) and TOKEN_RE.match(token) is not None
+
+
+def validate_token(token):
+    if not is_valid_token(token):
+        raise ValidationError(u'Device tokens must be 64 hexadecimal characters')
+
+
+def pack_token(token):
+    """
+    Converts a 64 character hexadecimal device token to its 32 byte binary form.
+
+    returns None if `token` isn't a valid device token.
+    """
+    try:
+        packed = unhexlify(token)
+    except (TypeError, ValueError):
+        return None
+    if len(packed) != TOKEN_LENGTH:
+        return None
+    return packed
+
+
+def unpack_token(packed):
+    return hexlify(packed)
+
+
+class BinaryTokenField(models.Field):
+    """
+    Stores a device token as a fixed width 32 byte binary column
+    so that lookups compare 32 bytes rather than a 64 character string.
+
+    Values are byte strings as returned by `pack_token`. The field is
+    derived from the hexadecimal token so it is neither editable nor serialized.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    description = 'A binary device token'
+
+    def __init__(self, *args, **kwargs):
+        kwargs['editable'] = False
+        kwargs['serialize'] = False
+        super(BinaryTokenField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        engine = connection.settings_dict['ENGINE']
+        if 'postgresql' in engine:
+            return 'bytea'
+        if 'mysql' in engine:
+            return 'binary(%d)' % TOKEN_LENGTH
+        if 'oracle' in engine:
+            return 'raw(%d)' % TOKEN_LENGTH
+        return 'blob'
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if 'mysql' in connection.settings_dict['ENGINE']:
+            return str(value)
+        return buffer(value)
+
+
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:
+    pass
+else:
+    add_introspection_rules([], ['^ios_notifications\.fields\.BinaryTokenField'])
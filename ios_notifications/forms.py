@@ -5,13 +5,45 @@ from django.forms.widgets import PasswordInput
 
 import OpenSSL
 from ios_notifications.models import Device, APNService
+from ios_notifications.connections import connection_pool, context_cache
+from ios_notifications.fields import normalize_token, validate_token
+
+
+class TokenField(forms.CharField):
+    """
+    A device token, normalized to 64 lowercase hexadecimal characters.
+    """
+    default_validators = [validate_token]
+
+    def to_python(self, value):
+        return normalize_token(super(TokenField, self).to_python(value))
 
 
 class DeviceForm(forms.ModelForm):
+    token = TokenField()
+
     class Meta:
         model = Device
 
 
+class DeviceRegistrationForm(forms.Form):
+    """
+    Validates a device registration through the API. Only the service's id is
+    looked up, rather than loading the service.
+    """
+    token = TokenField()
+    service = forms.IntegerField(min_value=1)
+    platform = forms.CharField(max_length=30, required=False)
+    display = forms.CharField(max_length=30, required=False)
+    os_version = forms.CharField(max_length=20, required=False)
+
+    def clean_service(self):
+        service_id = self.cleaned_data['service']
+        if not APNService.objects.filter(pk=service_id).exists():
+            raise forms.ValidationError('APNService with id %d does not exist' % service_id)
+        return service_id
+
+
 class APNServiceForm(forms.ModelForm):
     class Meta:
         model = APNService
@@ -24,6 +56,10 @@ class APNServiceForm(forms.ModelForm):
     END_ENCRYPTED_KEY = '-----END ENCRYPTED PRIVATE KEY-----'
 
     passphrase = forms.CharField(widget=PasswordInput(render_value=True), required=False)
+    concurrency = forms.IntegerField(min_value=1, required=False, initial=1,
+                                     help_text=APNService._meta.get_field('concurrency').help_text)
+    transport = forms.ChoiceField(choices=APNService.TRANSPORT_CHOICES, required=False, initial=APNService.TRANSPORT_APNS,
+                                  help_text=APNService._meta.get_field('transport').help_text)
 
     def clean_certificate(self):
         if not self.START_CERT or not self.END_CERT in self.cleaned_data['certificate']:
@@ -47,3 +83,17 @@ class APNServiceForm(forms.ModelForm):
             except OpenSSL.crypto.Error:
                 raise forms.ValidationError('The passphrase for the private key appears to be invalid')
         return self.cleaned_data['passphrase']
+
+    def clean_concurrency(self):
+        return self.cleaned_data['concurrency'] or 1
+
+    def clean_transport(self):
+        return self.cleaned_data['transport'] or APNService.TRANSPORT_APNS
+
+    def save(self, commit=True):
+        service = super(APNServiceForm, self).save(commit)
+        if service.pk is not None:
+            # Connections made with the old certificate or key shouldn't be reused.
+            context_cache.invalidate(service.get_context_key())
+            connection_pool.clear(service)
+        return service
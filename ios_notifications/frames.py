@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import select
+import struct
+import time
+
+import OpenSSL
+
+COMMAND = chr(0)
+COMMAND_ENHANCED = chr(1)
+TOKEN_LENGTH = 32
+
+
+class FrameBuilder(object):
+    """
+    Packs one notification payload into binary frames for many devices.
+
+    Everything in a frame except the device token (and the identifier when using
+    the enhanced format) is the same for every device, so the bytes either side
+    of the token are packed once when the builder is created.
+    """
+    identifier_struct = struct.Struct('!cI')
+
+    def __init__(self, payload, enhanced=False, expiry=0):
+        self.payload = payload
+        self.enhanced = enhanced
+        self.expiry = expiry
+        suffix = struct.Struct('!H%ds' % len(payload))
+        self._suffix = suffix.pack(len(payload), payload)
+        if enhanced:
+            self._prefix = struct.pack('!IH', expiry, TOKEN_LENGTH)
+        else:
+            self._prefix = struct.pack('!cH', COMMAND, TOKEN_LENGTH)
+        self.size = len(self._prefix) + TOKEN_LENGTH + len(self._suffix)
+        if enhanced:
+            self.size += self.identifier_struct.size
+
+    def pack(self, token, identifier=0):
+        """
+        Packs a single frame for `token`, the device token in binary form.
+        """
+        if len(token) != TOKEN_LENGTH:
+            raise ValueError('Device tokens must be %d bytes long' % TOKEN_LENGTH)
+        if self.enhanced:
+            return self.identifier_struct.pack(COMMAND_ENHANCED, identifier) + self._prefix + token + self._suffix
+        return self._prefix + token + self._suffix
+
+    def pack_many(self, tokens, first_identifier=0):
+        """
+        Packs frames for every binary token in `tokens` into one contiguous
+        buffer which can be written to the socket with a single `sendall`.
+        Enhanced frames are given consecutive identifiers starting at `first_identifier`.
+        """
+        pack = self.pack
+        if self.enhanced:
+            return ''.join([pack(token, identifier) for identifier, token in enumerate(tokens, first_identifier)])
+        return ''.join([pack(token) for token in tokens])
+
+
+class PayloadFrameBuilder(object):
+    """
+    Packs frames whose payload is different for each device, such as
+    personalized notifications rendered from a PayloadTemplate.
+
+    A struct is compiled once for each payload length rather than for every frame.
+    `size` is the size of the largest possible frame.
+    """
+    def __init__(self, enhanced=False, expiry=0, max_payload_size=256):
+        self.enhanced = enhanced
+        self.expiry = expiry
+        self.fmt = '!cIIH32sH%ds' if enhanced else '!cH32sH%ds'
+        self.size = struct.calcsize(self.fmt % max_payload_size)
+        self._structs = {}
+
+    def pack(self, token, identifier=0, payload=''):
+        if len(token) != TOKEN_LENGTH:
+            raise ValueError('Device tokens must be %d bytes long' % TOKEN_LENGTH)
+        packer = self._structs.get(len(payload))
+        if packer is None:
+            packer = self._structs[len(payload)] = struct.Struct(self.fmt % len(payload))
+        if self.enhanced:
+            return packer.pack(COMMAND_ENHANCED, identifier, self.expiry, TOKEN_LENGTH, token, len(payload), payload)
+        return packer.pack(COMMAND, TOKEN_LENGTH, token, len(payload), payload)
+
+
+class FrameWriter(object):
+    """
+    Gathers packed frames and writes them to a connection in buffers of
+    `buffer_size` bytes, so that many frames share one SSL record and one
+    system call rather than each frame being written on its own.
+
+    `frames_written` and `bytes_written` only count frames which have been
+    written in full. If writing fails the frames waiting in the buffer have
+    not been counted and can be sent again. `write_retries` counts the writes
+    which had to wait for the connection to accept more data.
+    """
+    def __init__(self, connection, buffer_size=65536):
+        self.connection = connection
+        self.buffer_size = buffer_size
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_retries = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, frame):
+        """
+        Adds a frame to the buffer, flushing the buffer once it is full.
+
+        returns True if the buffer was flushed.
+        """
+        self._buffer.append(frame)
+        self._buffered += len(frame)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """
+        Writes every buffered frame to the connection, retrying short writes until the
+        whole buffer has been sent. The connection is written to without blocking so a
+        write which has to wait for the socket to drain can be counted before waiting.
+        """
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self.connection.setblocking(False)
+        try:
+            while data:
+                # A write which has to wait is tried again with the same buffer, as OpenSSL requires.
+                try:
+                    data = data[self.connection.send(data):]
+                except OpenSSL.SSL.WantWriteError:
+                    self.write_retries += 1
+                    select.select([], [self.connection], [])
+                except OpenSSL.SSL.WantReadError:
+                    self.write_retries += 1
+                    select.select([self.connection], [], [])
+        finally:
+            self.connection.setblocking(True)
+        self.frames_written += len(self._buffer)
+        self.bytes_written += self._buffered
+        self._buffer = []
+        self._buffered = 0
+
+
+class PushResult(object):
+    """
+    A summary of a push to many devices.
+
+    `errors` holds a (status, device id) tuple for each error response from Apple.
+    `write_retries` counts the writes which had to wait for the socket to accept more data.
+    `unsent` holds the ids of devices the push read but gave up on sending, for example because
+    it could not connect again. Devices it hadn't read yet when it stopped aren't listed.
+    """
+    def __init__(self):
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.reconnects = 0
+        self.write_retries = 0
+        self.errors = []
+        self.unsent = []
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def add(self, writer):
+        self.frames_written += writer.frames_written
+        self.bytes_written += writer.bytes_written
+        self.write_retries += writer.write_retries
+
+    def merge(self, other):
+        """
+        Adds the counts from another PushResult, such as one from a single worker of a broadcast.
+        """
+        self.frames_written += other.frames_written
+        self.bytes_written += other.bytes_written
+        self.reconnects += other.reconnects
+        self.write_retries += other.write_retries
+        self.errors.extend(other.errors)
+        self.unsent.extend(other.unsent)
+
+    def finish(self):
+        self.finished_at = time.time()
+        return self
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def frames_per_second(self):
+        return self.frames_written / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_written / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<PushResult: %d frames, %d bytes in %.3fs, %.0f frames/sec>' % (
+            self.frames_written, self.bytes_written, self.elapsed, self.frames_per_second)
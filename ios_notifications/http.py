@@ -1,29 +1,139 @@
+import datetime
+import decimal
+
 from django.db.models.query import QuerySet
 from django.http import HttpResponse
-from django.core import serializers
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import is_protected_type, smart_unicode
 from django.utils import simplejson as json
+from django.utils.importlib import import_module
 
 
 class HttpResponseNotImplemented(HttpResponse):
     status_code = 501
 
 
+def get_json_module():
+    """
+    The module used to encode JSON, set with IOS_NOTIFICATIONS_JSON_MODULE
+    (e.g. 'ujson' or 'simplejson'). Defaults to the json module bundled with Django.
+    """
+    name = getattr(settings, 'IOS_NOTIFICATIONS_JSON_MODULE', None)
+    if name is None:
+        return json
+    return import_module(name)
+
+json_module = get_json_module()
+_encoder = DjangoJSONEncoder()
+
+
+class ModelSerializer(object):
+    """
+    Serializes model instances to dicts in the same format as Django's json serializer,
+    `{"pk": ..., "model": ..., "fields": {...}}`, without the serializer framework.
+
+    The fields to output are worked out once per model. Dates and decimals are converted
+    to strings as DjangoJSONEncoder would, so the dicts can be encoded by any JSON module.
+    """
+    def __init__(self, model, fields=None):
+        opts = model._meta
+        self.model_name = smart_unicode(opts)
+        self.local_fields = [f for f in opts.local_fields
+                             if f.serialize and not f.primary_key and (fields is None or f.name in fields)]
+        self.many_to_many = [f for f in opts.many_to_many
+                             if f.serialize and (fields is None or f.name in fields)]
+
+    def to_dict(self, obj, related=None):
+        """
+        `related` optionally maps each many to many field name to a dict of related ids
+        keyed by the object's primary key, saving a query per field.
+        """
+        data = {}
+        for field in self.local_fields:
+            if field.rel is not None:
+                value = getattr(obj, field.attname)
+            else:
+                value = field._get_val_from_obj(obj)
+                if not is_protected_type(value):
+                    value = field.value_to_string(obj)
+                elif isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+                    value = _encoder.default(value)
+            data[field.name] = value
+        for field in self.many_to_many:
+            if related is not None:
+                data[field.name] = related[field.name].get(obj.pk, [])
+            else:
+                data[field.name] = list(getattr(obj, field.name).values_list('pk', flat=True))
+        return {'pk': obj.pk, 'model': self.model_name, 'fields': data}
+
+    def related_ids(self, pks):
+        """
+        Looks up the related ids of every many to many field for the objects with `pks`,
+        one query per field.
+        """
+        related = {}
+        for field in self.many_to_many:
+            through = field.rel.through
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            ids = related[field.name] = {}
+            for pk, related_pk in through._default_manager.filter(**{'%s__in' % source: pks}) \
+                                                          .values_list(source, target):
+                ids.setdefault(pk, []).append(related_pk)
+        return related
+
+    def iter_json(self, queryset, chunk_size=500):
+        """
+        Yields a JSON list of every object in `queryset` piece by piece, reading the
+        queryset in chunks rather than loading it all into memory.
+        """
+        yield '['
+        first = True
+        chunk = []
+        for obj in queryset.iterator():
+            chunk.append(obj)
+            if len(chunk) == chunk_size:
+                for data in self._encode_chunk(chunk, first):
+                    yield data
+                first = False
+                chunk = []
+        if chunk:
+            for data in self._encode_chunk(chunk, first):
+                yield data
+        yield ']'
+
+    def _encode_chunk(self, chunk, first):
+        related = self.related_ids([obj.pk for obj in chunk]) if self.many_to_many else None
+        for i, obj in enumerate(chunk):
+            encoded = json_module.dumps(self.to_dict(obj, related))
+            yield encoded if first and i == 0 else ', ' + encoded
+
+
+_serializers = {}
+
+
+def get_serializer(model, fields=None):
+    key = (model, tuple(fields) if fields is not None else None)
+    if key not in _serializers:
+        _serializers[key] = ModelSerializer(model, fields)
+    return _serializers[key]
+
+
 class JSONResponse(HttpResponse):
     """
     A subclass of django.http.HttpResponse which serializes its content
     and returns a response with an application/json mimetype.
+
+    QuerySets are streamed to the client a chunk at a time.
+    `fields` optionally limits the model fields which are serialized.
     """
-    def __init__(self, content=None, content_type=None, status=None, mimetype='application/json'):
-        content = self.serialize(content) if content is not None else ''
+    def __init__(self, content=None, content_type=None, status=None, mimetype='application/json', fields=None):
+        content = self.serialize(content, fields) if content is not None else ''
         super(JSONResponse, self).__init__(content, content_type, status, mimetype)
 
-    def serialize(self, obj):
-        json_s = serializers.get_serializer('json')()
+    def serialize(self, obj, fields=None):
         if isinstance(obj, QuerySet):
-            return json_s.serialize(obj)
+            return get_serializer(obj.model, fields).iter_json(obj)
         elif isinstance(obj, dict):
-            return json.dumps(obj)
-
-        serialized_list = json_s.serialize([obj])
-        m = json.loads(serialized_list)[0]
-        return json.dumps(m)
+            return json_module.dumps(obj)
+        return json_module.dumps(get_serializer(obj.__class__, fields).to_dict(obj))
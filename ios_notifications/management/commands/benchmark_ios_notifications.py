@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import resource
+import struct
+import sys
+import time
+from array import array
+from binascii import hexlify
+
+from django.core.management.base import BaseCommand, CommandError
+from ios_notifications.models import APNService, FeedbackService, Notification, DeliveryTracker
+from ios_notifications.connections import connection_pool
+from ios_notifications.frames import FrameBuilder
+from ios_notifications.testing import FakeAPNServer, FakeFeedbackServer
+from ios_notifications.utils import generate_cert_and_pkey
+from optparse import make_option
+
+# Python 2 doesn't expose RUSAGE_THREAD, but Linux supports it.
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+INDEX = struct.Struct('!Q')
+
+
+def token_for(index):
+    """
+    A fake device token which encodes its index, so the server can tell which device a frame was for.
+    """
+    return hexlify(INDEX.pack(index) + '\0' * 24)
+
+
+def cpu_time(who=RUSAGE_THREAD):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss():
+    """
+    The peak resident set size of the process in megabytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class CountingTracker(DeliveryTracker):
+    """
+    Gathers deliveries as a DeliveryTracker does but only counts them when flushed,
+    since the generated devices aren't in the database and their ids may belong to real ones.
+    """
+    def __init__(self, enabled=True):
+        super(CountingTracker, self).__init__()
+        self.enabled = enabled
+        self.delivered_count = 0
+        self.invalid_count = 0
+
+    def flush(self):
+        with self._lock:
+            self.delivered_count += len(self._delivered)
+            self.invalid_count += len(self._invalid)
+            self._delivered, self._invalid = [], []
+
+
+class Command(BaseCommand):
+    help = 'Measures how fast notifications are sent and feedback is read, using local stand-ins for the Apple services.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--devices',
+            help='Comma separated numbers of devices to broadcast to',
+            dest='devices',
+            default='10000,100000,1000000'),
+        make_option('--enhanced',
+            help='Use the enhanced notification format',
+            action='store_true',
+            dest='enhanced',
+            default=False),
+        make_option('--error-every',
+            help='Have the fake APN service reject the token of every nth device',
+            dest='error_every',
+            default=None),
+        make_option('--disconnect-after',
+            help='Have the fake APN service drop each connection after this many frames',
+            dest='disconnect_after',
+            default=None),
+        make_option('--delay',
+            help='Seconds the fake APN service waits after each read',
+            dest='delay',
+            default=0),
+        make_option('--track',
+            help='Gather deliveries as a real broadcast does, without writing them to the database',
+            action='store_true',
+            dest='track',
+            default=False),
+        make_option('--feedback',
+            help='The number of feedback records to read, 0 to skip the feedback benchmark',
+            dest='feedback',
+            default=100000),)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['devices'].split(',')]
+            error_every = int(options['error_every']) if options['error_every'] else None
+            disconnect_after = int(options['disconnect_after']) if options['disconnect_after'] else None
+            delay = float(options['delay'])
+            feedback = int(options['feedback'])
+        except ValueError:
+            raise CommandError('The --devices, --error-every, --disconnect-after, --delay and --feedback options should pass numbers as their values')
+
+        cert, key = generate_cert_and_pkey()
+        # The service is never saved. An id of 0 matches no devices in the database.
+        service = APNService(id=0, name='benchmark', hostname='127.0.0.1', certificate=cert, private_key=key)
+        notification = Notification(message='Benchmark notification', service=service)
+
+        self.benchmark_packing(service, notification, max(sizes), options['enhanced'])
+        for size in sizes:
+            self.benchmark_push(service, notification, size, options['enhanced'], options['track'],
+                                error_every, disconnect_after, delay)
+        if feedback:
+            self.benchmark_feedback(service, feedback)
+
+    def benchmark_packing(self, service, notification, size, enhanced):
+        frames = FrameBuilder(service.get_payload(notification), enhanced)
+        tokens = [INDEX.pack(i) + '\0' * 24 for i in xrange(min(size, 100000))]
+        started, cpu = time.time(), cpu_time()
+        for identifier, token in enumerate(tokens):
+            frames.pack(token, identifier)
+        elapsed, cpu = time.time() - started, cpu_time() - cpu
+        self.stdout.write('pack: %d frames in %.3fs, %.0f frames/sec, %.2fus CPU/frame\n' % (
+            len(tokens), elapsed, len(tokens) / elapsed, cpu * 1e6 / len(tokens)))
+
+    def benchmark_push(self, service, notification, size, enhanced, track, error_every, disconnect_after, delay):
+        pulled = array('d', [0.0]) * size
+        arrived = array('d', [0.0]) * size
+
+        def on_frame(identifier, token):
+            index = INDEX.unpack_from(token)[0]
+            if not arrived[index]:
+                arrived[index] = time.time()
+
+        def rows():
+            for index in xrange(size):
+                if not pulled[index]:
+                    pulled[index] = time.time()
+                yield index, token_for(index)
+
+        invalid = [token_for(i) for i in xrange(error_every - 1, size, error_every)] if error_every else ()
+        server = FakeAPNServer(invalid, delay, disconnect_after, record=False, on_frame=on_frame)
+        server.start()
+        service.PORT = server.port
+        tracker = CountingTracker(track)
+        try:
+            if not connection_pool.acquire(service):
+                raise CommandError('Could not connect to the fake APN service')
+            connection_pool.release(service)
+            started, cpu = time.time(), cpu_time()
+            result = service._push(notification, rows(), enhanced, tracker=tracker)
+            tracker.flush()
+            elapsed, cpu = time.time() - started, cpu_time() - cpu
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        if result is None:
+            raise CommandError('The connection to the fake APN service was lost')
+
+        latencies = sorted(a - p for a, p in zip(arrived, pulled) if a and p)
+        sent = result.frames_written
+        self.stdout.write('push %d devices: %d frames in %.3fs, %.0f msgs/sec, %.2fus CPU/msg, %d reconnects, %d errors\n' % (
+            size, sent, elapsed, sent / elapsed, cpu * 1e6 / max(sent, 1), result.reconnects, len(result.errors)))
+        if latencies:
+            self.stdout.write('    latency p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms; max RSS %.1fMB\n' % (
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+                percentile(latencies, 0.99) * 1000, latencies[-1] * 1000, max_rss()))
+
+    def benchmark_feedback(self, service, size):
+        records = ((int(time.time()), token_for(index)) for index in xrange(size))
+        server = FakeFeedbackServer(records, chunk_size=65536)
+        server.start()
+        feedback = FeedbackService(name='benchmark', hostname='127.0.0.1', apn_service=service)
+        feedback.PORT = server.port
+        if not feedback.connect():
+            raise CommandError('Could not connect to the fake feedback service')
+        started, cpu = time.time(), cpu_time()
+        batches = len(list(feedback.deactivate_devices()))
+        elapsed, cpu = time.time() - started, cpu_time() - cpu
+        server.join(1)
+        self.stdout.write('feedback: %d records in %d batches in %.3fs, %.0f records/sec, %.2fus CPU/record\n' % (
+            size, batches, elapsed, size / elapsed, cpu * 1e6 / size))
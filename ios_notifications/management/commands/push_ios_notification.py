@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.core.management.base import BaseCommand, CommandError
-from ios_notifications.models import Notification, APNService
+from ios_notifications.models import Notification, APNService, NotificationPayloadSizeExceeded
 from optparse import make_option
 
 # TODO: argparse for Python 2.7
@@ -29,6 +29,17 @@ class Command(BaseCommand):
             help='The id of the APN Service to send this notification through',
             dest='service',
             default=None
+        ),
+        make_option('--enqueue',
+            help='Queue the notification to be sent by run_ios_notification_worker instead of sending it immediately',
+            action='store_true',
+            dest='enqueue',
+            default=False
+        ),
+        make_option('--workers',
+            help='The number of connections to send the notification over in parallel. Defaults to the concurrency of the APN Service',
+            dest='workers',
+            default=None
         )
     )
 
@@ -46,14 +57,29 @@ class Command(BaseCommand):
                 options['badge'] = int(options['badge'])
             except ValueError:
                 raise CommandError('The --badge option should pass an integer as its value')
+        if options['workers'] is not None:
+            try:
+                options['workers'] = int(options['workers'])
+            except ValueError:
+                raise CommandError('The --workers option should pass an integer as its value')
         try:
             service = APNService.objects.get(pk=service_id)
         except APNService.DoesNotExist:
             raise CommandError('APNService with id %d does not exist' % service_id)
 
-        if not Notification.is_valid_length(options['message'], options['badge'], options['sound']):
+        notification = Notification(message=options['message'], badge=options['badge'], service=service, sound=options['sound'])
+        # The encoded payload is cached on the notification and reused when it is sent.
+        try:
+            service.get_payload(notification)
+        except NotificationPayloadSizeExceeded:
             raise CommandError('Notification exceeds the maximum payload length. Try making your message shorter.')
-
-        notification = Notification.objects.create(message=options['message'], badge=options['badge'], service=service, sound=options['sound'])
-        service.push_notification_to_devices(notification)
+        notification.save()
+        if options['enqueue']:
+            notification.enqueue()
+            self.stdout.write('Notification queued successfully\n')
+            return
+        result = service.push_notification_to_devices(notification, workers=options['workers'])
         self.stdout.write('Notification pushed successfully\n')
+        if result is not None and int(options.get('verbosity', 1)) > 1:
+            self.stdout.write('%d notifications, %d bytes in %.3fs, %.0f notifications/sec\n' % (
+                result.frames_written, result.bytes_written, result.elapsed, result.frames_per_second))
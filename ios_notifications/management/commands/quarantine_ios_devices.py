@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import datetime
+import itertools
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+from ios_notifications.models import Device
+from ios_notifications.fields import normalize_token, is_valid_token, pack_token
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Finds devices whose tokens were never normalized or stored in binary form. Tokens which can be ' \
+           'normalized are fixed, devices which turn out to duplicate another device of their service are merged ' \
+           'into it and the rest are malformed and the devices are deactivated.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--service',
+            help='Only check the devices of the APN Service with this id',
+            dest='service',
+            default=None),
+        make_option('--chunk-size',
+            help='The number of devices to read, or deactivate, at once',
+            dest='chunk_size',
+            default=500),
+        make_option('--dry-run',
+            help='Report what would change without changing anything',
+            action='store_true',
+            dest='dry_run',
+            default=False),)
+
+    def handle(self, *args, **options):
+        try:
+            chunk_size = int(options['chunk_size'])
+            service_id = int(options['service']) if options['service'] is not None else None
+        except ValueError:
+            raise CommandError('The --service and --chunk-size options should pass integers as their values')
+
+        devices = Device.objects.all()
+        if service_id is not None:
+            devices = devices.filter(service__id=service_id)
+
+        fixed = 0
+        merged = 0
+        malformed = []
+        for pk, service, token in self.unnormalized(devices, chunk_size):
+            normalized = normalize_token(token)
+            if not is_valid_token(normalized):
+                malformed.append(pk)
+                continue
+            existing = Device.objects.filter(service__id=service, token=normalized).exclude(pk=pk)
+            existing = existing.values_list('id', flat=True)[:1]
+            if existing:
+                if not options['dry_run']:
+                    self.merge(pk, existing[0])
+                merged += 1
+            elif options['dry_run'] or self.fix(pk, normalized):
+                fixed += 1
+            else:
+                # Another device of the service was given the normalized token meanwhile.
+                self.merge(pk, Device.objects.get(service__id=service, token=normalized).pk)
+                merged += 1
+
+        if not options['dry_run']:
+            now = datetime.datetime.now()
+            ids = iter(malformed)
+            while True:
+                chunk = list(itertools.islice(ids, chunk_size))
+                if not chunk:
+                    break
+                Device.objects.filter(id__in=chunk, is_active=True).update(is_active=False, deactivated_at=now)
+
+        def describe(count, noun, verb):
+            if options['dry_run']:
+                return '%d %s%s would be %s' % (count, noun, '' if count == 1 else 's', verb)
+            return '%d %s%s %s' % (count, noun, ' was' if count == 1 else 's were', verb)
+        self.stdout.write('%s, %s, %s.\n' % (
+            describe(fixed, 'device token', 'fixed'), describe(merged, 'duplicate device', 'merged'),
+            describe(len(malformed), 'malformed device', 'deactivated')))
+
+    def unnormalized(self, devices, chunk_size):
+        """
+        Yields the (id, service id, token) of each device whose token has no binary form
+        or isn't normalized, such as the upper case tokens stored by older versions.
+        """
+        last_id = 0
+        while True:
+            rows = list(devices.filter(id__gt=last_id).order_by('id')
+                               .values_list('id', 'service', 'token', 'token_bin')[:chunk_size])
+            if not rows:
+                break
+            for pk, service, token, token_bin in rows:
+                if token_bin is None or token != normalize_token(token):
+                    yield pk, service, token
+            last_id = rows[-1][0]
+
+    def fix(self, pk, token):
+        sid = transaction.savepoint()
+        try:
+            Device.objects.filter(pk=pk).update(token=token, token_bin=pack_token(token))
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        transaction.commit_unless_managed()
+        return True
+
+    def merge(self, pk, device_id):
+        """
+        Merges the device `pk` into the device `device_id`, which has the same token in
+        normalized form: its users are moved over, the device is activated again if the
+        duplicate was still active and the duplicate is deleted.
+        """
+        with transaction.commit_on_success():
+            duplicate = Device.objects.get(pk=pk)
+            device = Device.objects.get(pk=device_id)
+            device.users.add(*duplicate.users.all())
+            if duplicate.is_active:
+                Device.objects.filter(pk=device_id).update(is_active=True, deactivated_at=None)
+            duplicate.delete()
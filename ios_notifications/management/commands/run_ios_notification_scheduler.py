@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from ios_notifications.models import NotificationJob
+from ios_notifications.management.commands import run_ios_notification_worker
+
+
+class Command(run_ios_notification_worker.Command):
+    help = 'Runs a worker which queues notifications once their send_at time has passed and pushes them, ' \
+           'along with any other queued notifications.'
+
+    def claim(self, lease):
+        for job in NotificationJob.enqueue_due():
+            if self.verbosity > 1:
+                self.stdout.write('%s queued.\n' % job)
+        return NotificationJob.claim(lease)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from ios_notifications.models import NotificationJob
+from ios_notifications.connections import connection_pool
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Runs a worker which pushes queued notifications in the background.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once',
+            help='Exit once there are no more queued notifications instead of waiting for more',
+            action='store_true',
+            dest='once',
+            default=False),
+        make_option('--sleep',
+            help='The number of seconds to wait before checking for new jobs when the queue is empty',
+            dest='sleep',
+            default=5),
+        make_option('--chunk-size',
+            help='The number of devices to send to before saving the progress of a job',
+            dest='chunk_size',
+            default=None),
+        make_option('--lease',
+            help='The number of seconds after which a job claimed by a worker which has stopped responding is run again',
+            dest='lease',
+            default=300),
+        make_option('--max-attempts',
+            help='The number of times a job is attempted before it is marked as failed',
+            dest='max_attempts',
+            default=3),)
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        try:
+            sleep = float(options['sleep'])
+            lease = int(options['lease'])
+            max_attempts = int(options['max_attempts'])
+            chunk_size = int(options['chunk_size']) if options['chunk_size'] is not None else None
+        except ValueError:
+            raise CommandError('The --sleep, --lease, --max-attempts and --chunk-size options should pass numbers as their values')
+
+        try:
+            while True:
+                job = self.claim(lease)
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(sleep)
+                    continue
+                self.run_job(job, chunk_size, max_attempts)
+        finally:
+            connection_pool.close_all()
+
+    def claim(self, lease):
+        return NotificationJob.claim(lease)
+
+    def run_job(self, job, chunk_size, max_attempts):
+        try:
+            sent = job.run(chunk_size)
+        except Exception:
+            job.error = traceback.format_exc()
+            job.status = NotificationJob.FAILED if job.attempts >= max_attempts else NotificationJob.QUEUED
+            job.save()
+            self.stderr.write('%s failed:\n%s\n' % (job, job.error))
+            return
+        if sent:
+            if self.verbosity > 0:
+                self.stdout.write('%s finished.\n' % job)
+        elif job.attempts >= max_attempts:
+            job.status = NotificationJob.FAILED
+            job.save()
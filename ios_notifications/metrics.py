@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+import socket
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from ios_notifications import signals
+
+logger = logging.getLogger('ios_notifications')
+
+
+class MetricsBackend(object):
+    """
+    The interface for metrics backends. Subclasses should override `timing` and `incr`.
+    Metric names are dotted strings such as `ios_notifications.apn.production.frames`.
+    """
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+
+class StatsdBackend(MetricsBackend):
+    """
+    Sends metrics to a StatsD server over UDP.
+
+    Configured with IOS_NOTIFICATIONS_STATSD_HOST (default '127.0.0.1'),
+    IOS_NOTIFICATIONS_STATSD_PORT (default 8125) and IOS_NOTIFICATIONS_STATSD_PREFIX,
+    which is prepended to every metric name.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or getattr(settings, 'IOS_NOTIFICATIONS_STATSD_HOST', '127.0.0.1'),
+                        port or getattr(settings, 'IOS_NOTIFICATIONS_STATSD_PORT', 8125))
+        prefix = prefix if prefix is not None else getattr(settings, 'IOS_NOTIFICATIONS_STATSD_PREFIX', '')
+        self.prefix = prefix + '.' if prefix and not prefix.endswith('.') else prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds):
+        self.send('%s%s:%d|ms' % (self.prefix, name, seconds * 1000))
+
+    def incr(self, name, value=1):
+        self.send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def send(self, data):
+        # Metrics must never break a push, so errors are only logged.
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error as e:
+            logger.debug('Could not send metric to StatsD: %s', e)
+
+
+class LoggingBackend(MetricsBackend):
+    """
+    Logs metrics to the `ios_notifications.metrics` logger at DEBUG level.
+    """
+    logger = logging.getLogger('ios_notifications.metrics')
+
+    def timing(self, name, seconds):
+        self.logger.debug('%s %.3fms', name, seconds * 1000)
+
+    def incr(self, name, value=1):
+        self.logger.debug('%s +%d', name, value)
+
+
+def metric_name(service, metric):
+    """
+    Builds a metric name for a service, e.g. `ios_notifications.apn.production.frames`.
+    """
+    kind = 'feedback' if service.__class__.__name__ == 'FeedbackService' else 'apn'
+    name = re.sub(r'[^\w-]+', '_', service.name or str(service.pk)).strip('_').lower()
+    return 'ios_notifications.%s.%s.%s' % (kind, name, metric)
+
+
+class MetricsRecorder(object):
+    """
+    Forwards the signals sent while pushing notifications and reading feedback to a metrics backend.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def receivers(self):
+        return [(signals.service_connected, self.service_connected),
+                (signals.service_connection_failed, self.service_connection_failed),
+                (signals.push_finished, self.push_finished),
+                (signals.deliveries_recorded, self.deliveries_recorded),
+                (signals.devices_deactivated, self.devices_deactivated)]
+
+    def connect(self):
+        for signal, receiver in self.receivers():
+            signal.connect(receiver)
+
+    def disconnect(self):
+        for signal, receiver in self.receivers():
+            signal.disconnect(receiver)
+
+    def service_connected(self, sender, service, handshake_time, **kwargs):
+        self.backend.timing(metric_name(service, 'handshake'), handshake_time)
+
+    def service_connection_failed(self, sender, service, error, **kwargs):
+        self.backend.incr(metric_name(service, 'connection_failures'))
+
+    def push_finished(self, sender, service, notification, result, **kwargs):
+        self.backend.timing(metric_name(service, 'push'), result.elapsed)
+        self.backend.incr(metric_name(service, 'frames'), result.frames_written)
+        self.backend.incr(metric_name(service, 'bytes'), result.bytes_written)
+        if result.reconnects:
+            self.backend.incr(metric_name(service, 'reconnects'), result.reconnects)
+        if result.write_retries:
+            self.backend.incr(metric_name(service, 'write_retries'), result.write_retries)
+        if result.errors:
+            self.backend.incr(metric_name(service, 'errors'), len(result.errors))
+
+    def deliveries_recorded(self, sender, delivered, invalid, duration, **kwargs):
+        self.backend.timing('ios_notifications.bookkeeping', duration)
+        self.backend.incr('ios_notifications.delivered', delivered)
+        if invalid:
+            self.backend.incr('ios_notifications.invalid_tokens', invalid)
+
+    def devices_deactivated(self, sender, service, count, **kwargs):
+        self.backend.incr(metric_name(service, 'deactivated'), count)
+
+
+def get_backend(path=None):
+    """
+    Instantiates the backend named by IOS_NOTIFICATIONS_METRICS_BACKEND, a dotted path
+    such as 'ios_notifications.metrics.StatsdBackend'. returns None if it isn't set.
+    """
+    if path is None:
+        path = getattr(settings, 'IOS_NOTIFICATIONS_METRICS_BACKEND', None)
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+
+recorder = None
+
+
+def install(backend=None):
+    """
+    Connects a metrics backend, by default the one in settings, to the push signals.
+    """
+    global recorder
+    if backend is None:
+        backend = get_backend()
+    if recorder is not None:
+        recorder.disconnect()
+        recorder = None
+    if backend is not None:
+        recorder = MetricsRecorder(backend)
+        recorder.connect()
+    return recorder
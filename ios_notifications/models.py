@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import logging
 import socket
+import select
+import collections
+import copy
+import itertools
+import threading
+import Queue
 import struct
-from binascii import hexlify, unhexlify
+import time
 import datetime
 
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError
 from django.contrib.auth.models import User
 from django.utils import simplejson as json
 from django_fields.fields import EncryptedCharField
@@ -12,6 +19,16 @@ from django.conf import settings
 
 import OpenSSL
 
+from ios_notifications.connections import connection_pool, context_cache
+from ios_notifications.frames import FrameBuilder, FrameWriter, PayloadFrameBuilder, PushResult
+from ios_notifications.payload import PayloadTemplate, PayloadEncoder
+from ios_notifications.throttle import TokenBucket, Throttle, get_bucket
+from ios_notifications import transports
+from ios_notifications import metrics, signals
+from ios_notifications.fields import BinaryTokenField, pack_token, normalize_token, validate_token
+
+logger = logging.getLogger('ios_notifications')
+
 
 class NotificationPayloadSizeExceeded(Exception):
     def __init__(self, message='The notification maximum payload size of 256 bytes was exceeded'):
@@ -28,6 +45,160 @@ class InvalidPassPhrase(Exception):
         super(InvalidPassPhrase, self).__init__(message)
 
 
+class DeviceStream(object):
+    """
+    Iterates over the (id, token) of every device in a QuerySet.
+
+    Devices are fetched in chunks ordered by id, each chunk starting after the
+    id of the last device yielded, so memory use stays flat however many devices
+    there are. `last_id` is the id of the last device yielded and can be passed
+    back in to resume from that position.
+
+    With `packed=True` the binary form of each token is yielded instead, and
+    devices without a valid token are skipped. Each device is yielded once even if
+    the QuerySet is filtered across a many to many relation: the rows of a device
+    come one after another when ordered by id, so repeats are skipped here rather
+    than with a DISTINCT on every chunk.
+    """
+    def __init__(self, queryset, chunk_size=None, last_id=0, packed=False):
+        self.queryset = queryset
+        self.chunk_size = chunk_size or getattr(settings, 'IOS_NOTIFICATIONS_DEVICE_CHUNK_SIZE', 1000)
+        self.last_id = last_id
+        self.packed = packed
+
+    def __iter__(self):
+        while True:
+            queryset = self.queryset.filter(id__gt=self.last_id).order_by('id')
+            if self.packed:
+                rows = list(queryset.values_list('id', 'token_bin')[:self.chunk_size])
+            else:
+                rows = list(queryset.values_list('id', 'token')[:self.chunk_size])
+            for row in rows:
+                if row[0] == self.last_id:
+                    continue
+                self.last_id = row[0]
+                if not self.packed:
+                    yield row
+                elif row[1] is not None:
+                    yield row[0], str(row[1])
+            if len(rows) < self.chunk_size:
+                return
+
+
+class PackedRows(object):
+    """
+    Wraps an iterable of (id, token) rows whose tokens are already in binary
+    form, so they are written without being decoded again.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class DeliveryTracker(object):
+    """
+    Gathers the ids of devices a notification was delivered to, and of devices
+    Apple rejected for having an invalid token, and writes them to the database
+    in chunked bulk UPDATEs rather than saving each device.
+
+    Recording `last_notified_at` can be turned off with the
+    IOS_NOTIFICATIONS_TRACK_LAST_NOTIFIED setting; invalid tokens are always
+    deactivated. With `autoflush=False` nothing is written until `flush` is
+    called, which lets the writes be deferred to another thread.
+    """
+    def __init__(self, autoflush=True):
+        self.enabled = getattr(settings, 'IOS_NOTIFICATIONS_TRACK_LAST_NOTIFIED', True)
+        self.chunk_size = getattr(settings, 'IOS_NOTIFICATIONS_BOOKKEEPING_CHUNK_SIZE', 500)
+        self.autoflush = autoflush
+        self.instances = {}
+        self._delivered = []
+        self._invalid = []
+        self._lock = threading.Lock()
+
+    def watch(self, devices):
+        """
+        Keeps `last_notified_at` up to date on the given Device instances when they are flushed.
+        """
+        for device in devices:
+            self.instances[device.pk] = device
+
+    def delivered(self, device_ids):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._delivered.extend(device_ids)
+            full = len(self._delivered) >= self.chunk_size
+        if full and self.autoflush:
+            self.flush()
+
+    def invalid(self, device_id):
+        with self._lock:
+            self._invalid.append(device_id)
+
+    def flush(self):
+        with self._lock:
+            delivered, self._delivered = self._delivered, []
+            invalid, self._invalid = self._invalid, []
+        if not delivered and not invalid:
+            return
+        started = time.time()
+        now = datetime.datetime.now()
+        for i in xrange(0, len(delivered), self.chunk_size):
+            Device.objects.filter(pk__in=delivered[i:i + self.chunk_size]).update(last_notified_at=now)
+        for i in xrange(0, len(invalid), self.chunk_size):
+            Device.objects.filter(pk__in=invalid[i:i + self.chunk_size]).update(is_active=False, deactivated_at=now)
+        for device_id in delivered:
+            if device_id in self.instances:
+                self.instances[device_id].last_notified_at = now
+        for device_id in invalid:
+            if device_id in self.instances:
+                self.instances[device_id].is_active = False
+                self.instances[device_id].deactivated_at = now
+        signals.deliveries_recorded.send(sender=self.__class__, delivered=len(delivered), invalid=len(invalid),
+                                         duration=time.time() - started)
+
+
+class BroadcastWorker(threading.Thread):
+    """
+    Writes a notification to the devices put on its queue over its own
+    connection to the APN service. Used by APNService to broadcast a
+    notification over several connections at once.
+    """
+    def __init__(self, service, notification, tracker, enhanced=None, expiry=None, throttle=None):
+        super(BroadcastWorker, self).__init__()
+        self.daemon = True
+        self.service = copy.copy(service)
+        self.service.connection = None
+        self.notification = notification
+        self.tracker = tracker
+        self.enhanced = enhanced
+        self.expiry = expiry
+        self.throttle = throttle
+        self.queue = Queue.Queue(getattr(settings, 'IOS_NOTIFICATIONS_DEVICE_CHUNK_SIZE', 1000))
+        self.result = None
+        self.error = None
+        self.unsent = []
+
+    def run(self):
+        rows = iter(self.queue.get, None)
+        try:
+            self.result = self.service._push(self.notification, PackedRows(rows), self.enhanced, self.expiry,
+                                             self.tracker, throttle=self.throttle)
+        except Exception as e:
+            self.error = e
+        # Drain the queue so that put() never blocks on a failed worker. The rows drained were never sent.
+        self.unsent = [row[0] for row in rows]
+
+    def put(self, row):
+        self.queue.put(row)
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+
+
 class BaseService(models.Model):
     """
     A base service class intended to be subclassed.
@@ -37,15 +208,56 @@ class BaseService(models.Model):
     PORT = 0  # Should be overriden by subclass
     connection = None
 
+    def open_transport(self):
+        """
+        Returns a stand-in for the connection to the service when it shouldn't
+        send to Apple, or None to connect as usual.
+        """
+        return None
+
     def connect(self, certificate, private_key, passphrase=None):
         """
         Establishes an encrypted SSL socket connection to the service.
         After connecting the socket can be written to or read from.
         """
+        started = time.time()
+        transport = self.open_transport()
+        if transport is not None:
+            self.connection = transport
+            signals.service_connected.send(sender=self.__class__, service=self, handshake_time=time.time() - started)
+            return True
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        context = self.get_context(certificate, private_key, passphrase)
+        self.connection = OpenSSL.SSL.Connection(context, sock)
+        try:
+            self.connection.connect((self.hostname, self.PORT))
+            self.connection.set_connect_state()
+            self.resume_session(self.connection)
+            self.connection.do_handshake()
+            self.save_session(self.connection)
+        except Exception as e:
+            logger.warning('Could not connect to %s:%d: %r', self.hostname, self.PORT, e, exc_info=True)
+            signals.service_connection_failed.send(sender=self.__class__, service=self, error=e)
+            return False
+        signals.service_connected.send(sender=self.__class__, service=self, handshake_time=time.time() - started)
+        return True
+
+    def get_context(self, certificate, private_key, passphrase=None):
+        """
+        Returns the SSL context used for connections to the service.
+        Contexts are cached per service and only rebuilt when the credentials change.
+        """
+        fingerprint = context_cache.fingerprint(certificate, private_key, passphrase)
+        return context_cache.get(self.get_context_key(), fingerprint,
+                                 lambda: self.create_context(certificate, private_key, passphrase))
+
+    def create_context(self, certificate, private_key, passphrase=None):
+        """
+        Creates the SSL context used for connections to the service.
+        """
         # ssl in Python < 3.2 does not support certificates/keys as strings.
         # See http://bugs.python.org/issue3823
         # Therefore pyOpenSSL which lets us do this is a dependancy.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, certificate)
         args = [OpenSSL.crypto.FILETYPE_PEM, private_key]
         if passphrase is not None:
@@ -55,18 +267,38 @@ class BaseService(models.Model):
         except OpenSSL.crypto.Error:
             raise InvalidPassPhrase
         context = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv3_METHOD)
+        # The APN services don't use TLS 1.3, and when a TLS 1.3 connection is reset before the session
+        # tickets sent after the handshake have been read, OpenSSL can't read the error response sent with them.
+        context.set_options(getattr(OpenSSL.SSL, 'OP_NO_TLSv1_3', 0))
         context.use_certificate(cert)
         context.use_privatekey(pkey)
-        self.connection = OpenSSL.SSL.Connection(context, sock)
-        self.connection.connect((self.hostname, self.PORT))
-        self.connection.set_connect_state()
-        try:
-            self.connection.do_handshake()
-            return True
-        except Exception as e:
-            if getattr(settings, 'DEBUG', False):
-                print e, e.__class__
-        return False
+        if hasattr(context, 'set_session_cache_mode'):
+            context.set_session_cache_mode(OpenSSL.SSL.SESS_CACHE_CLIENT)
+        return context
+
+    def get_context_key(self):
+        """
+        The key under which the SSL context for the service's credentials is cached.
+        """
+        return (self.__class__.__name__, self.pk)
+
+    def resume_session(self, connection):
+        """
+        Offers the TLS session from the last connection to the same host so that the
+        handshake can be abbreviated. Does nothing if pyOpenSSL is too old to support it.
+        """
+        session = context_cache.get_session(self.get_context_key(), (self.hostname, self.PORT))
+        if session is not None and hasattr(connection, 'set_session'):
+            try:
+                connection.set_session(session)
+            except OpenSSL.SSL.Error:
+                pass
+
+    def save_session(self, connection):
+        if hasattr(connection, 'get_session'):
+            session = connection.get_session()
+            if session is not None:
+                context_cache.set_session(self.get_context_key(), (self.hostname, self.PORT), session)
 
     def disconnect(self):
         """
@@ -75,6 +307,7 @@ class BaseService(models.Model):
         if self.connection is not None:
             self.connection.shutdown()
             self.connection.close()
+            self.connection = None
 
     class Meta:
         abstract = True
@@ -87,13 +320,51 @@ class APNService(BaseService):
 
     `private_key` is optional if both the certificate and key are provided in
     `certificate`.
+
+    `transport` can be set to 'null' or 'file' to load test sending without Apple.
+    Notifications go through the whole pipeline, but the frames are thrown away or
+    appended to a capture file instead of being sent.
     """
+    TRANSPORT_APNS = 'apns'
+    TRANSPORT_NULL = 'null'
+    TRANSPORT_FILE = 'file'
+    TRANSPORT_CHOICES = (
+        (TRANSPORT_APNS, 'Apple Push Notification service'),
+        (TRANSPORT_NULL, 'Discard notifications'),
+        (TRANSPORT_FILE, 'Capture notifications to a file'),
+    )
+
     certificate = models.TextField()
     private_key = models.TextField()
     passphrase = EncryptedCharField(null=True, blank=True, help_text='Passphrase for the private key')
+    concurrency = models.PositiveIntegerField(default=1,
+                                              help_text='The number of connections used to send a notification to every device')
+    rate_limit = models.PositiveIntegerField(null=True, blank=True,
+                                             help_text='The most notifications to send each second across all connections, '
+                                                       'or blank for no limit')
+    transport = models.CharField(max_length=10, choices=TRANSPORT_CHOICES, default=TRANSPORT_APNS,
+                                 help_text='Where notifications are sent. Use the null or file transports for load testing')
 
     PORT = 2195
     fmt = '!cH32sH%ds'
+    enhanced_fmt = '!cIIH32sH%ds'
+    error_response_fmt = '!cBI'
+
+    # Error response status codes
+    NO_ERRORS = 0
+    PROCESSING_ERROR = 1
+    MISSING_DEVICE_TOKEN = 2
+    MISSING_TOPIC = 3
+    MISSING_PAYLOAD = 4
+    INVALID_TOKEN_SIZE = 5
+    INVALID_TOPIC_SIZE = 6
+    INVALID_PAYLOAD_SIZE = 7
+    INVALID_TOKEN = 8
+    UNKNOWN_ERROR = 255
+
+    # How many times in a row the frames in flight are sent again from the same frame
+    # after the connection is dropped without an error response.
+    MAX_BLIND_RESENDS = 10
 
     def connect(self):
         """
@@ -102,22 +373,238 @@ class APNService(BaseService):
         """
         return super(APNService, self).connect(self.certificate, self.private_key, self.passphrase)
 
-    def push_notification_to_devices(self, notification, devices=None):
+    def open_transport(self):
+        if self.transport == self.TRANSPORT_NULL:
+            return transports.NullConnection()
+        if self.transport == self.TRANSPORT_FILE:
+            return transports.FileConnection(transports.get_capture_path(self))
+        return None
+
+    def push_notification_to_devices(self, notification, devices=None, enhanced=None, expiry=None, workers=None):
         """
         Sends the specific notification to devices.
         if `devices` is not supplied, all devices in the `APNService`'s device
         list will be sent the notification.
+
+        If `enhanced` is True the enhanced binary format is used, which lets
+        Apple report the identifier of a notification it rejected.
+        Defaults to the value of IOS_NOTIFICATIONS_ENHANCED_FORMAT in settings.
+        `expiry` is an optional datetime after which Apple should stop trying
+        to deliver the notification and only applies to the enhanced format.
+
+        When `devices` is a QuerySet it is sent over `workers` connections
+        in parallel, which defaults to the service's `concurrency`.
+
+        Sending is paced by the service's `rate_limit` and the notification's `spread`.
+
+        returns an ios_notifications.frames.PushResult or None if a connection could not be made.
         """
         if devices is None:
             devices = self.device_set.filter(is_active=True)
-        if self.connect():
-            self._write_message(notification, devices)
-            self.disconnect()
+        if workers is None:
+            workers = self.concurrency
+        throttle = self.get_throttle(notification, devices)
+        if workers > 1 and isinstance(devices, models.query.QuerySet) and devices.query.can_filter():
+            result = self._broadcast(notification, devices, workers, enhanced, expiry, throttle)
+        else:
+            result = self._push(notification, devices, enhanced, expiry, throttle=throttle)
+        if result is not None:
+            notification.last_sent_at = datetime.datetime.now()
+            notification.save()
+        return result
+
+    def push_to_users(self, notification, user_ids, enhanced=None, expiry=None, chunk_size=None):
+        """
+        Sends the notification over one connection to the active devices of every user in `user_ids`.
+
+        `user_ids` may be any iterable, including a generator of millions of ids. It is read in chunks of
+        `chunk_size` ids (IOS_NOTIFICATIONS_USER_CHUNK_SIZE in settings, 500 by default) and the devices
+        of each chunk are looked up with one query. A device shared by several users is only sent
+        the notification once.
+
+        returns an ios_notifications.frames.PushResult or None if a connection could not be made.
+        """
+        rows = PackedRows(self._user_device_rows(user_ids, chunk_size))
+        return self.push_notification_to_devices(notification, rows, enhanced, expiry, workers=1)
+
+    def _user_device_rows(self, user_ids, chunk_size=None):
+        """
+        Yields an (id, binary token) row for each distinct active device of the users in `user_ids`.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'IOS_NOTIFICATIONS_USER_CHUNK_SIZE', 500)
+        seen = set()
+        user_ids = iter(user_ids)
+        while True:
+            chunk = list(itertools.islice(user_ids, chunk_size))
+            if not chunk:
+                break
+            devices = self.device_set.filter(is_active=True, token_bin__isnull=False, users__id__in=chunk)
+            for pk, token in devices.values_list('id', 'token_bin').distinct():
+                if pk not in seen:
+                    seen.add(pk)
+                    yield pk, str(token)
+
+    def push_personalized(self, notification, devices, enhanced=None, expiry=None):
+        """
+        Sends a personalized version of the notification to each device over one connection.
 
-    def _write_message(self, notification, devices):
+        `devices` is an iterable of (device, overrides) pairs where device is a Device or an
+        (id, token) tuple and overrides is a dict of keys to change in the notification's `aps`
+        dictionary for that device, e.g. `{'badge': 3}` or `{'alert': u'Bonjour'}`.
+        Payloads are rendered from a PayloadTemplate of the notification as they are sent.
+        Devices whose payload would exceed 256 bytes are skipped and reported in the result's
+        `errors` with the INVALID_PAYLOAD_SIZE status.
+
+        returns an ios_notifications.frames.PushResult or None if a connection could not be made.
+        """
+        if enhanced is None:
+            enhanced = getattr(settings, 'IOS_NOTIFICATIONS_ENHANCED_FORMAT', False)
+        if isinstance(expiry, datetime.datetime):
+            expiry = int(time.mktime(expiry.timetuple()))
+        template = PayloadTemplate(self.get_aps(notification))
+        frames = PayloadFrameBuilder(enhanced, expiry or 0, template.max_size)
+        skipped = []
+        rows = PackedRows(self._personalized_rows(template, devices, skipped))
+        result = self._push(notification, rows, enhanced, expiry, frames=frames)
+        if result is not None:
+            result.errors.extend([(self.INVALID_PAYLOAD_SIZE, device_id) for device_id in skipped])
+            notification.last_sent_at = datetime.datetime.now()
+            notification.save()
+        return result
+
+    def _personalized_rows(self, template, devices, skipped):
+        """
+        Yields an (id, binary token, payload) row for each (device, overrides) pair,
+        adding the id of any device whose payload is too long to `skipped`.
+        Devices with malformed tokens are skipped.
+        """
+        for device, overrides in devices:
+            if isinstance(device, Device):
+                device = (device.pk, device.get_packed_token())
+            else:
+                device = (device[0], pack_token(device[1]))
+            if device[1] is None:
+                logger.warning('Skipping device %s with a malformed token', device[0])
+                continue
+            payload = template.render(overrides)
+            if payload is None:
+                skipped.append(device[0])
+            else:
+                yield device[0], device[1], payload
+
+    def get_throttle(self, notification=None, devices=None):
+        """
+        Returns a Throttle pacing a push to the service's `rate_limit`, shared by every
+        push of the service in this process, and to the notification's `spread` when the
+        number of `devices` is known. returns None if sending shouldn't be paced.
+        """
+        buckets = []
+        if self.rate_limit:
+            buckets.append(get_bucket(self))
+        if notification is not None and notification.spread:
+            if isinstance(devices, models.query.QuerySet):
+                count = devices.count()
+            elif isinstance(devices, (list, tuple)):
+                count = len(devices)
+            else:
+                count = None
+            if count:
+                buckets.append(TokenBucket(float(count) / notification.spread))
+        return Throttle(*buckets) if buckets else None
+
+    def _push(self, notification, devices, enhanced=None, expiry=None, tracker=None, frames=None, throttle=None):
+        """
+        Writes the message to the supplied devices over a single connection.
+        """
+        if throttle is None:
+            throttle = self.get_throttle(notification, devices)
+        if not getattr(settings, 'IOS_NOTIFICATIONS_PERSISTENT_CONNECTIONS', True):
+            if self.connect():
+                result = self._write_message(notification, devices, enhanced, expiry, tracker, frames, throttle)
+                self.disconnect()
+                return result
+            return None
+        if connection_pool.acquire(self):
+            try:
+                result = self._write_message(notification, devices, enhanced, expiry, tracker, frames, throttle)
+            except Exception:
+                connection_pool.discard(self)
+                raise
+            connection_pool.release(self)
+            return result
+        return None
+
+    def _broadcast(self, notification, devices, workers, enhanced=None, expiry=None, throttle=None):
+        """
+        Spreads `devices` across `workers` BroadcastWorker threads by id,
+        each with its own connection to the service.
+
+        The devices are streamed in this thread and handed to the worker given by
+        their id modulo `workers`, so every worker has devices to send from the start.
+        Workers only write to their connections, the database is only used from this
+        thread, which is also where deliveries recorded by the workers are flushed.
+        The devices of a worker which can't connect, or gives up, are listed in the
+        result's `unsent`.
+        """
+        result = PushResult()
+        if not devices.exists():
+            return result.finish()
+        tracker = DeliveryTracker(autoflush=False)
+        threads = [BroadcastWorker(self, notification, tracker, enhanced, expiry, throttle) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i, row in enumerate(DeviceStream(devices, packed=True)):
+                threads[row[0] % workers].put(row)
+                if (i + 1) % tracker.chunk_size == 0:
+                    tracker.flush()
+        finally:
+            for thread in threads:
+                thread.finish()
+        tracker.flush()
+        connected = False
+        for thread in threads:
+            if thread.error is not None:
+                raise thread.error
+            if thread.result is not None:
+                connected = True
+                result.merge(thread.result)
+            result.unsent.extend(thread.unsent)
+        result.unsent.sort()
+        return result.finish() if connected else None
+
+    def _write_message(self, notification, devices, enhanced=None, expiry=None, tracker=None, frames=None,
+                       throttle=None):
         """
         Writes the message for the supplied devices to
         the APN Service SSL socket.
+
+        Frames are gathered into buffers of IOS_NOTIFICATIONS_WRITE_BUFFER_SIZE
+        bytes which are each written in one go by a FrameWriter.
+        If the connection is dropped sending resumes on a new connection from the
+        first frame that was not written. When using the enhanced format each frame
+        carries an identifier, so if Apple rejects a frame sending resumes straight
+        after the rejected device instead. If the connection is dropped without an
+        error response every frame in flight is sent again, see `_blind_drop`. Frames
+        sent again are written IOS_NOTIFICATIONS_RESEND_BUFFER_SIZE bytes at a time and
+        each write waits for an error response before the next, see `_confirm`.
+
+        `devices` may be a QuerySet, a list of Device instances or any other
+        iterable of (id, token) tuples. QuerySets are streamed with a DeviceStream
+        so that only the id and token of a chunk of devices is held in memory at once.
+        Tokens are sent in the binary form stored with each device; devices with
+        malformed tokens are skipped rather than stopping the push.
+
+        Deliveries are recorded with `tracker`, an optional DeliveryTracker.
+        If one isn't supplied a tracker is created and flushed before returning.
+
+        `frames` packs the frames and defaults to a FrameBuilder for the notification's
+        payload. Any values in a row after the token are passed on to `frames.pack`.
+
+        `throttle` is an optional ios_notifications.throttle.Throttle which paces the
+        frames written. Buffers are then shrunk to hold about 50ms of frames so the
+        pacing isn't undone by large bursts.
         """
         if not isinstance(notification, Notification):
             raise TypeError('notification should be an instance of ios_notifications.models.Notification')
@@ -126,53 +613,307 @@ class APNService(BaseService):
             if not self.connect():
                 return
 
-        payload = self.get_payload(notification)
+        if enhanced is None:
+            enhanced = getattr(settings, 'IOS_NOTIFICATIONS_ENHANCED_FORMAT', False)
+        if isinstance(expiry, datetime.datetime):
+            expiry = int(time.mktime(expiry.timetuple()))
+        buffer_size = getattr(settings, 'IOS_NOTIFICATIONS_WRITE_BUFFER_SIZE', 65536)
+        timeout = getattr(settings, 'IOS_NOTIFICATIONS_ERROR_RESPONSE_TIMEOUT', 0.5)
 
-        for device in devices:
+        if frames is None:
+            frames = FrameBuilder(self.get_payload(notification), enhanced, expiry or 0)
+        if throttle is not None:
+            buffer_size = min(buffer_size, max(int(throttle.rate // 20), 1) * frames.size)
+        batch = buffer_size // frames.size + 1
+        # Frames are kept until they are older than the resend window so they
+        # can be sent again if the connection drops or Apple rejects a frame.
+        window = max(getattr(settings, 'IOS_NOTIFICATIONS_RESEND_WINDOW', 5000), batch)
+        result = PushResult()
+        flush = tracker is None
+        if flush:
+            tracker = DeliveryTracker()
+        rows = iter(self._device_rows(devices, tracker))
+        # The first `backlog` rows have been read before and are waiting to be sent again.
+        backlog = 0
+        blind = None
+        while True:
+            writer = FrameWriter(self.connection, buffer_size)
+            in_flight = collections.deque()
+            error = None
+            closed = False
+            allowance = 0
+            read = 0
+            # Frames sent again may include another frame Apple rejects, and writing on past it resets the
+            # connection before the error response can be read. So they are written a few at a time and
+            # each write waits for an error response, or is confirmed as delivered, before the next.
+            careful = backlog if enhanced else 0
+            if careful:
+                writer.buffer_size = self._resend_size(buffer_size, frames.size, blind) * frames.size
             try:
-                self.connection.send(self.pack_message(payload, device))
-            except OpenSSL.SSL.WantWriteError:
-                self.disconnect()
-                i = devices.index(device)
-                if isinstance(devices, models.query.QuerySet):
-                    devices.update(last_notified_at=datetime.datetime.now())
-                devices[:i].update(last_notified_at=datetime.datetime.now())
-                return self._write_message(notification, devices[i:]) if self.connect() else None
-        if isinstance(devices, models.query.QuerySet):
-            devices.update(last_notified_at=datetime.datetime.now())
-        else:
-            for device in devices:
-                device.last_notified_at = datetime.datetime.now()
-                device.save()
-        notification.last_sent_at = datetime.datetime.now()
-        notification.save()
+                for identifier, row in enumerate(rows):
+                    read = identifier + 1
+                    if throttle is not None:
+                        if not allowance:
+                            if identifier >= careful:
+                                writer.flush()
+                            allowance = throttle.acquire(batch)
+                        allowance -= 1
+                    in_flight.append((identifier, row))
+                    flushed = writer.write(frames.pack(row[1], identifier, *row[2:]))
+                    if identifier < careful:
+                        if flushed or identifier + 1 == careful:
+                            error, closed = self._confirm(writer, in_flight, tracker, timeout)
+                            if error is not None or closed:
+                                break
+                            if identifier + 1 == careful:
+                                writer.buffer_size = buffer_size
+                    elif flushed:
+                        delivered = []
+                        while len(in_flight) > window and in_flight[0][0] < writer.frames_written:
+                            delivered.append(in_flight.popleft()[1][0])
+                        tracker.delivered(delivered)
+                        if enhanced:
+                            error, closed = self._receive_error_response()
+                            if error is not None or closed:
+                                break
+                else:
+                    writer.flush()
+                    if enhanced:
+                        error, closed = self._receive_error_response(timeout)
+            except (OpenSSL.SSL.SysCallError, OpenSSL.SSL.ZeroReturnError):
+                closed = True
+                if enhanced:
+                    error = self.read_error_response(timeout)
+            result.add(writer)
+            backlog = max(backlog - read, 0)
 
-    def get_payload(self, notification):
+            if error is None and not closed:
+                tracker.delivered([row[0] for identifier, row in in_flight])
+                break
+
+            if error is None:
+                # The connection was dropped without Apple saying which frame it rejected.
+                failed, blind = self._blind_drop(in_flight, writer.frames_written, enhanced, blind)
+                error = (None, failed)
+            else:
+                blind = None
+            status, failed = error
+            connection_pool.discard(self)
+            if failed is None:
+                retry = [row for identifier, row in in_flight]
+            else:
+                retry = self._settle(in_flight, status, failed, tracker, result)
+            # Rows to send again stay ahead of the rest, and of each other, if the next connection drops too.
+            rows = itertools.chain(retry, rows)
+            backlog += len(retry)
+            stopped = failed is None or (status is None and writer.frames_written == 0)
+            if not stopped and not backlog:
+                try:
+                    rows = itertools.chain([rows.next()], rows)
+                except StopIteration:
+                    break
+                backlog = 1
+            if not stopped:
+                result.reconnects += 1
+                stopped = not self.connect()
+            if stopped:
+                result.unsent.extend(row[0] for row in itertools.islice(rows, backlog))
+                break
+        if flush:
+            tracker.flush()
+        result.finish()
+        signals.push_finished.send(sender=self.__class__, service=self, notification=notification, result=result)
+        return result
+
+    def _device_rows(self, devices, tracker):
+        """
+        Returns an iterable of (id, binary token) rows for `devices`, which may be a QuerySet,
+        a list of Device instances, a PackedRows or any other iterable of (id, token) tuples.
+        """
+        if isinstance(devices, PackedRows) or (isinstance(devices, DeviceStream) and devices.packed):
+            return devices
+        if isinstance(devices, models.query.QuerySet) and devices.query.can_filter():
+            return DeviceStream(devices, packed=True)
+        if isinstance(devices, (list, tuple, models.query.QuerySet)) and all(isinstance(d, Device) for d in devices):
+            tracker.watch(devices)
+            rows = [(device.pk, device.get_packed_token()) for device in devices]
+            return [row for row in rows if row[1] is not None]
+        return self._pack_rows(devices)
+
+    def _pack_rows(self, rows):
+        """
+        Converts the tokens of (id, token) rows to binary, skipping malformed tokens.
+        """
+        for row in rows:
+            token = pack_token(row[1])
+            if token is None:
+                logger.warning('Skipping device %s with a malformed token', row[0])
+                continue
+            yield (row[0], token) + tuple(row[2:])
+
+    def _blind_drop(self, in_flight, written, enhanced, blind):
+        """
+        Works out which frame to resend from when the connection was dropped
+        without an error response, after `written` frames were written.
+
+        In the simple format the frames written are taken to be delivered. In the
+        enhanced format Apple discards every frame after one it rejects, and the error
+        response can be lost when the connection is reset, so none of the frames in
+        flight are known to be delivered and all of them are sent again. Devices whose
+        frame had already been accepted get the notification twice.
+
+        `blind` is None or the (device id, count) of the oldest frame in flight the last
+        times this happened in a row. Once the same frame has been resent from
+        MAX_BLIND_RESENDS times the push gives up, so a connection which is always
+        dropped can't hold it up forever.
+
+        returns the identifier of the first frame to send again, or None to give up,
+        and the new `blind`.
+        """
+        if not enhanced or not in_flight:
+            return written, None
+        oldest = in_flight[0][1][0]
+        count = blind[1] + 1 if blind is not None and blind[0] == oldest else 1
+        if count > self.MAX_BLIND_RESENDS:
+            logger.warning('The connection to %s was dropped %d times in a row without an error response; '
+                           'giving up', self.hostname, count - 1)
+            return None, None
+        return in_flight[0][0], (oldest, count)
+
+    def _resend_size(self, buffer_size, frame_size, blind):
+        """
+        returns how many frames to write at a time when sending frames again, which is
+        IOS_NOTIFICATIONS_RESEND_BUFFER_SIZE bytes worth, halved each time the connection
+        has been dropped in a row without an error response, and at least one.
+        """
+        size = min(buffer_size, getattr(settings, 'IOS_NOTIFICATIONS_RESEND_BUFFER_SIZE', 16384))
+        if blind is not None:
+            size >>= blind[1] - 1
+        return max(size // frame_size, 1)
+
+    def _confirm(self, writer, in_flight, tracker, timeout):
+        """
+        Writes the buffered frames and waits up to `timeout` seconds for an error response.
+        If none arrives and the connection is still open every frame in flight is delivered.
+
+        returns a tuple of the error response and whether the connection was closed.
+        """
+        writer.flush()
+        error, closed = self._receive_error_response(timeout)
+        if error is None and not closed:
+            tracker.delivered([row[0] for identifier, row in in_flight])
+            in_flight.clear()
+        return error, closed
+
+    def _settle(self, in_flight, status, failed, tracker, result):
+        """
+        Works out what happened to the frames in flight on a connection which
+        was dropped, either by Apple rejecting the frame with identifier `failed`
+        or, when `status` is None, because of an error writing that frame.
+
+        Frames before `failed` were delivered. Frames after it were discarded
+        by Apple and are returned as the (id, token) rows to send again.
+        """
+        tracker.delivered([row[0] for identifier, row in in_flight if identifier < failed])
+        retry = []
+        for identifier, row in in_flight:
+            if identifier > failed or (identifier == failed and status is None):
+                retry.append(row)
+            elif identifier == failed:
+                result.errors.append((status, row[0]))
+                if status == self.INVALID_TOKEN:
+                    tracker.invalid(row[0])
+        return retry
+
+    def read_error_response(self, timeout=0):
+        """
+        Reads an error response from Apple without blocking for longer than `timeout` seconds.
+        Only notifications sent in the enhanced format will be given an error response.
+
+        returns a tuple of (status, identifier) or None if there is no error response.
+        """
+        return self._receive_error_response(timeout)[0]
+
+    def _receive_error_response(self, timeout=0):
+        """
+        Reads an error response as `read_error_response` does.
+
+        returns a tuple of the error response and whether the connection was closed.
+        """
+        if self.connection is None:
+            raise NotConnectedException
+        deadline = time.time() + timeout
+        data = ''
+        self.connection.setblocking(False)
+        try:
+            while len(data) < 6:
+                try:
+                    readable, writable, errored = select.select([self.connection], [], [],
+                                                                max(deadline - time.time(), 0))
+                except (select.error, ValueError):
+                    return None, True
+                if not readable:
+                    return None, False
+                try:
+                    chunk = self.connection.recv(6 - len(data))
+                except OpenSSL.SSL.WantReadError:
+                    # Only TLS records without application data have arrived.
+                    continue
+                except (OpenSSL.SSL.ZeroReturnError, OpenSSL.SSL.SysCallError):
+                    return None, True
+                if not chunk:
+                    return None, True
+                data += chunk
+        finally:
+            self.connection.setblocking(True)
+        command, status, identifier = struct.unpack(self.error_response_fmt, data)
+        return (status, identifier), False
+
+    def get_aps(self, notification):
         aps = {'alert': notification.message}
         if notification.badge is not None:
             aps['badge'] = notification.badge
         if notification.sound is not None:
             aps['sound'] = notification.sound
+        return aps
 
-        message = {'aps': aps}
-        payload = json.dumps(message, separators=(',', ':'))
+    def get_payload(self, notification, truncate=None):
+        """
+        Encodes the notification's payload. The payload is cached on the notification,
+        so it is only encoded again if the aps dictionary changes.
 
-        if len(payload) > 256:
-            raise NotificationPayloadSizeExceeded
+        Unless `truncate` or IOS_NOTIFICATIONS_TRUNCATE_ALERTS is True,
+        NotificationPayloadSizeExceeded is raised for payloads over 256 bytes.
+        Otherwise the alert is shortened to fit.
+        """
+        if truncate is None:
+            truncate = getattr(settings, 'IOS_NOTIFICATIONS_TRUNCATE_ALERTS', False)
+        aps = self.get_aps(notification)
+        cached = getattr(notification, '_payload_cache', None)
+        if cached is not None and cached[0] == (aps, truncate):
+            return cached[1]
 
+        payload = PayloadEncoder(truncate_alert=truncate).encode(aps)
+        if payload is None:
+            raise NotificationPayloadSizeExceeded
+        notification._payload_cache = ((aps, truncate), payload)
         return payload
 
-    def pack_message(self, payload, device):
+    def pack_message(self, payload, device, identifier=None, expiry=0):
         """
         Converts a notification payload into binary form.
+        If an `identifier` is supplied the enhanced format is used.
         """
         if len(payload) > 256:
             raise NotificationPayloadSizeExceeded
         if not isinstance(device, Device):
             raise TypeError('device must be an instance of ios_notifications.models.Device')
 
-        msg = struct.pack(self.fmt % len(payload), chr(0), 32, unhexlify(device.token), len(payload), payload)
-        return msg
+        token = device.get_packed_token()
+        if token is None:
+            raise ValueError('The device token %r is not valid' % device.token)
+        frames = FrameBuilder(payload, identifier is not None, expiry)
+        return frames.pack(token, identifier or 0)
 
     def __unicode__(self):
         return u'APNService %s' % self.name
@@ -191,6 +932,12 @@ class Notification(models.Model):
     sound = models.CharField(max_length=30, null=True, default='default')
     created_at = models.DateTimeField(auto_now_add=True)
     last_sent_at = models.DateTimeField(null=True, blank=True)
+    send_at = models.DateTimeField(null=True, blank=True, db_index=True,
+                                   help_text='When to send the notification to every device, '
+                                             'picked up by the run_ios_notification_scheduler command')
+    spread = models.PositiveIntegerField(null=True, blank=True,
+                                         help_text='The number of seconds to spread sending over, or blank to send '
+                                                   'as fast as the service allows')
 
     def push_to_all_devices(self):
         """
@@ -199,13 +946,33 @@ class Notification(models.Model):
         """
         self.service.push_notification_to_devices(self)
 
+    def push_to_users(self, user_ids):
+        """
+        Pushes this notification to the active devices of the users with `user_ids`
+        using the notification's related APN service.
+        """
+        return self.service.push_to_users(self, user_ids)
+
+    def enqueue(self, target=None):
+        """
+        Queues this notification to be pushed in the background by the
+        `run_ios_notification_worker` management command.
+
+        `target` is an optional dict of Device filter arguments used to
+        limit which of the service's active devices are sent the notification.
+
+        returns an ios_notifications.models.NotificationJob
+        """
+        return NotificationJob.objects.create(notification=self, target=json.dumps(target) if target else None)
+
     def __unicode__(self):
         return u'Notification: %s' % self.message
 
     @staticmethod
     def is_valid_length(message, badge=None, sound=None):
         """
-        Determines if a notification payload is a valid length.
+        Determines if a notification payload is a valid length,
+        measured in bytes once the payload has been encoded as UTF-8.
 
         returns bool
         """
@@ -214,26 +981,140 @@ class Notification(models.Model):
             aps['badge'] = badge
         if sound is not None:
             aps['sound'] = sound
-        message = {'aps': aps}
-        payload = json.dumps(message, separators=(',', ':'))
-        return len(payload) <= 256
+        return PayloadEncoder().encode(aps) is not None
+
+
+class DeviceManager(models.Manager):
+    def filter_token(self, token):
+        """
+        Returns the devices with `token`, looked up by the indexed binary form of the token.
+        """
+        token = normalize_token(token)
+        packed = pack_token(token)
+        if packed is None:
+            return self.get_query_set().filter(token=token)
+        return self.get_query_set().filter(token_bin=packed)
+
+    def register(self, token, service_id, **fields):
+        """
+        Creates a device or marks an existing one as active again in a single statement
+        where the database supports it. Any other `fields` are only set on new devices.
+
+        returns a (device, created) tuple.
+        """
+        token = normalize_token(token)
+        if self.supports_upsert():
+            return self._upsert([token], service_id, fields)[0]
+        return self._create_or_activate(token, service_id, fields)
+
+    def register_many(self, tokens, service_id):
+        """
+        Registers every token in `tokens` for a service, as `register` does for one token.
+
+        returns a list of (device, created) tuples, one for each distinct token.
+        """
+        seen = set()
+        tokens = [token for token in map(normalize_token, tokens) if not (token in seen or seen.add(token))]
+        if not tokens:
+            return []
+        if self.supports_upsert():
+            return self._upsert(tokens, service_id, {})
+        return [self._create_or_activate(token, service_id, {}) for token in tokens]
+
+    def supports_upsert(self):
+        """
+        INSERT ... ON CONFLICT is used on PostgreSQL 9.5 and later.
+        """
+        connection = connections[self.db]
+        if connection.vendor != 'postgresql':
+            return False
+        if connection.connection is None:
+            # The server version is read from the open connection.
+            connection.cursor()
+        return connection.pg_version >= 90500
+
+    def _upsert(self, tokens, service_id, fields):
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        now = datetime.datetime.now()
+        columns = [f for f in opts.local_fields if not isinstance(f, models.AutoField)]
+        rows, params = [], []
+        for token in tokens:
+            device = self.model(token=token, token_bin=pack_token(token), service_id=service_id,
+                                is_active=True, last_registered_at=now, **fields)
+            rows.append('(%s)' % ', '.join(['%s'] * len(columns)))
+            params.extend([f.get_db_prep_save(f.pre_save(device, True), connection=connection) for f in columns])
+        sql = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s, %s) DO UPDATE SET %s = TRUE, %s = EXCLUDED.%s ' \
+              'RETURNING %s, xmax = 0' % (
+                  qn(opts.db_table), ', '.join([qn(f.column) for f in columns]), ', '.join(rows),
+                  qn(opts.get_field('token').column), qn(opts.get_field('service').column),
+                  qn(opts.get_field('is_active').column),
+                  qn(opts.get_field('last_registered_at').column), qn(opts.get_field('last_registered_at').column),
+                  ', '.join([qn(f.column) for f in opts.local_fields]))
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        attnames = [f.attname for f in opts.local_fields]
+        registered = [(self.model(**dict(zip(attnames, row[:-1]))), row[-1]) for row in cursor.fetchall()]
+        transaction.commit_unless_managed(using=self.db)
+        return registered
+
+    def _create_or_activate(self, token, service_id, fields):
+        """
+        Activates the existing device, and only if there isn't one inserts the device
+        inside a savepoint. Most registrations are of devices which already exist, so
+        they don't pay for a failed INSERT. If another process inserts the device in the
+        meantime the unique constraint on token and service is hit and it is activated.
+        """
+        now = datetime.datetime.now()
+        devices = self.get_query_set().filter(token=token, service__id=service_id)
+        if not devices.update(is_active=True, last_registered_at=now):
+            device = self.model(token=token, service_id=service_id, is_active=True, last_registered_at=now, **fields)
+            sid = transaction.savepoint(using=self.db)
+            try:
+                device.save(force_insert=True, using=self.db)
+                transaction.savepoint_commit(sid, using=self.db)
+                return device, True
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+            devices.update(is_active=True, last_registered_at=now)
+        transaction.commit_unless_managed(using=self.db)
+        return devices.get(), False
 
 
 class Device(models.Model):
     """
     Represents an iOS device with unique token.
     """
-    token = models.CharField(max_length=64, blank=False, null=False)
+    token = models.CharField(max_length=64, blank=False, null=False, validators=[validate_token])
+    token_bin = BinaryTokenField(null=True, db_index=True)
     is_active = models.BooleanField(default=True)
     deactivated_at = models.DateTimeField(null=True, blank=True)
     service = models.ForeignKey(APNService)
     users = models.ManyToManyField(User, null=True, blank=True, related_name='ios_devices')
     added_at = models.DateTimeField(auto_now_add=True)
+    last_registered_at = models.DateTimeField(null=True, blank=True)
     last_notified_at = models.DateTimeField(null=True, blank=True)
     platform = models.CharField(max_length=30, blank=True, null=True)
     display = models.CharField(max_length=30, blank=True, null=True)
     os_version = models.CharField(max_length=20, blank=True, null=True)
 
+    objects = DeviceManager()
+
+    def save(self, *args, **kwargs):
+        self.token = normalize_token(self.token)
+        self.token_bin = pack_token(self.token)
+        super(Device, self).save(*args, **kwargs)
+
+    def get_packed_token(self):
+        """
+        The binary form of the token, or None if the token is malformed.
+        The form stored when the device was saved is used if there is one.
+        """
+        if self.token_bin is not None:
+            return self.token_bin
+        return pack_token(self.token)
+
     def push_notification(self, notification):
         """
         Pushes a ios_notifications.models.Notification instance to an the device.
@@ -243,7 +1124,6 @@ class Device(models.Model):
             raise TypeError('notification should be an instance of ios_notifications.models.Notification')
 
         notification.service.push_notification_to_devices(notification, [self])
-        self.save()
 
     def __unicode__(self):
         return u'Device %s' % self.token
@@ -252,6 +1132,133 @@ class Device(models.Model):
         unique_together = ('token', 'service')
 
 
+class NotificationJob(models.Model):
+    """
+    A notification waiting to be pushed in the background.
+
+    Jobs are claimed by `run_ios_notification_worker` and sent in chunks of devices
+    ordered by id. `cursor` is the id of the last device sent so far and is saved
+    after every chunk, so if a worker dies another worker picks the job up again
+    once its claim has expired and carries on from the cursor.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    notification = models.ForeignKey(Notification, related_name='jobs')
+    target = models.TextField(null=True, blank=True, help_text='JSON encoded Device filter arguments')
+    cursor = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def claim(cls, lease=300):
+        """
+        Claims the oldest queued job, or a running job whose claim is older than
+        `lease` seconds because the worker running it has died.
+
+        returns a NotificationJob or None if there are no jobs waiting.
+        """
+        now = datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=lease)
+        with transaction.commit_on_success():
+            jobs = list(cls.objects.select_for_update()
+                        .filter(models.Q(status=cls.QUEUED) | models.Q(status=cls.RUNNING, claimed_at__lt=expired))
+                        .order_by('created_at')[:1])
+            if not jobs:
+                return None
+            job = jobs[0]
+            job.status = cls.RUNNING
+            job.claimed_at = now
+            job.attempts += 1
+            job.save()
+        return job
+
+    @classmethod
+    def enqueue_due(cls, now=None):
+        """
+        Queues a job for each notification whose `send_at` has passed and which hasn't been
+        sent or queued yet. Due notifications without a job are found with one query on the
+        indexed `send_at` column, so notifications already queued aren't read or locked again,
+        and are locked while their jobs are created, so two schedulers don't both queue them.
+        Jobs are excluded with a subquery as PostgreSQL can't lock rows across an outer join.
+
+        returns a list of the new NotificationJobs.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        with transaction.commit_on_success():
+            due = list(Notification.objects.select_for_update()
+                       .filter(send_at__lte=now, last_sent_at__isnull=True)
+                       .exclude(pk__in=cls.objects.values('notification')).order_by('send_at'))
+            return [notification.enqueue() for notification in due]
+
+    def get_devices(self):
+        devices = self.notification.service.device_set.filter(is_active=True)
+        if self.target:
+            # Targets spanning a relation, e.g. users__id__in, match a device once per related row.
+            devices = devices.filter(**dict((str(k), v) for k, v in json.loads(self.target).items())).distinct()
+        return devices
+
+    def run(self, chunk_size=None):
+        """
+        Pushes the notification to the job's devices, starting after the cursor
+        and saving the cursor after each chunk of devices is sent.
+
+        If a chunk can't be sent in full, because a connection couldn't be made or
+        the push gave up on some devices, the cursor is saved just before the first
+        device which wasn't sent and the job is queued again.
+
+        returns bool
+        """
+        notification = self.notification
+        service = notification.service
+        devices = self.get_devices()
+        throttle = service.get_throttle(notification, devices.filter(id__gt=self.cursor))
+        stream = DeviceStream(devices, chunk_size, self.cursor, packed=True)
+        rows = iter(stream)
+        while True:
+            chunk = list(itertools.islice(rows, stream.chunk_size))
+            if not chunk:
+                break
+            result = service._push(notification, PackedRows(chunk), throttle=throttle)
+            if result is None or result.unsent:
+                if result is None:
+                    self.error = 'Could not connect to %s' % service
+                else:
+                    first = min(result.unsent)
+                    sent = [row[0] for row in chunk if row[0] < first]
+                    if sent:
+                        self.cursor = sent[-1]
+                    self.error = 'Could not send to %d devices of %s' % (len(result.unsent), service)
+                self.status = self.QUEUED
+                self.save()
+                return False
+            self.cursor = chunk[-1][0]
+            self.claimed_at = datetime.datetime.now()
+            self.save()
+        notification.last_sent_at = datetime.datetime.now()
+        notification.save()
+        self.status = self.DONE
+        self.finished_at = datetime.datetime.now()
+        self.save()
+        return True
+
+    def __unicode__(self):
+        return u'NotificationJob %s: %s' % (self.notification_id, self.status)
+
+
 class FeedbackService(BaseService):
     """
     The service provided by Apple to inform you of devices which no longer have your app installed
@@ -265,35 +1272,94 @@ class FeedbackService(BaseService):
     PORT = 2196
 
     fmt = '!lh32s'
+    record = struct.Struct(fmt)
 
     def connect(self):
         """
         Establishes an encrypted socket connection to the feedback service.
         """
-        return super(FeedbackService, self).connect(self.apn_service.certificate, self.apn_service.private_key)
+        return super(FeedbackService, self).connect(self.apn_service.certificate, self.apn_service.private_key,
+                                                    self.apn_service.passphrase)
+
+    def open_transport(self):
+        # An APN service which isn't sending to Apple has no feedback to read.
+        if self.apn_service.transport != APNService.TRANSPORT_APNS:
+            return transports.NullConnection()
+        return None
+
+    def get_context_key(self):
+        # The feedback service uses the credentials of its APN service so shares its context.
+        return self.apn_service.get_context_key()
 
     def call(self):
         """
         Calls the feedback service and deactivates any devices the feedback service mentions.
+
+        returns the number of devices deactivated, or None if the feedback service could not be reached.
         """
         if self.connect():
-            device_tokens = []
-            try:
-                while True:
-                    data = self.connection.recv(38)  # 38 being the length in bytes of the binary format feedback tuple.
-                    timestamp, token_length, token = struct.unpack(self.fmt, data)
-                    device_token = hexlify(token)
-                    device_tokens.append(device_token)
-            except OpenSSL.SSL.ZeroReturnError:
-                # Nothing to receive
-                pass
-            devices = Device.objects.filter(token__in=device_tokens, service=self.apn_service)
-            devices.update(is_active=False, deactivated_at=datetime.datetime.now())
+            return sum(self.deactivate_devices())
+
+    def deactivate_devices(self, batch_size=None):
+        """
+        Reads the feedback tuples from an open connection as they arrive and deactivates the
+        devices they mention in batches of `batch_size` tokens, so a large backlog never has to
+        be held in memory or looked up with a single query.
+
+        A device is left active if it was registered again after the time Apple reports
+        the app was removed from it.
+
+        This is a generator yielding the number of devices deactivated for each batch.
+        The connection is closed once the feedback service has sent everything.
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, 'IOS_NOTIFICATIONS_FEEDBACK_BATCH_SIZE', 500)
+        size = self.record.size
+        buf = ''
+        batch = {}
+        try:
+            while True:
+                try:
+                    data = self.connection.recv(65536)
+                except (OpenSSL.SSL.ZeroReturnError, OpenSSL.SSL.SysCallError):
+                    # The feedback service closes the connection once it has nothing more to send.
+                    data = ''
+                if not data:
+                    break
+                buf += data
+                end = len(buf) - len(buf) % size
+                for offset in xrange(0, end, size):
+                    timestamp, token_length, token = self.record.unpack_from(buf, offset)
+                    batch[token] = max(timestamp, batch.get(token, 0))
+                    if len(batch) >= batch_size:
+                        yield self._deactivate(batch)
+                        batch = {}
+                buf = buf[end:]
+            if batch:
+                yield self._deactivate(batch)
+        finally:
             self.disconnect()
-            return devices.count()
+
+    def _deactivate(self, batch):
+        """
+        Deactivates the devices for a dict of feedback timestamps keyed by binary device token.
+        """
+        ids = []
+        devices = Device.objects.filter(service=self.apn_service, token_bin__in=batch.keys(), is_active=True)
+        for pk, token, added_at, last_registered_at in devices.values_list('id', 'token_bin', 'added_at',
+                                                                           'last_registered_at'):
+            if datetime.datetime.fromtimestamp(batch[str(token)]) > (last_registered_at or added_at):
+                ids.append(pk)
+        if ids:
+            Device.objects.filter(id__in=ids).update(is_active=False, deactivated_at=datetime.datetime.now())
+        signals.devices_deactivated.send(sender=self.__class__, service=self, count=len(ids))
+        return len(ids)
 
     def __unicode__(self):
         return u'FeedbackService %s' % self.name
 
     class Meta:
         unique_together = ('name', 'hostname')
+
+
+metrics.install()
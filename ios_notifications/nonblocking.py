@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+import errno
+import itertools
+import select
+import socket
+import struct
+import time
+
+from django.conf import settings
+
+import OpenSSL
+
+from ios_notifications.frames import FrameBuilder, PushResult
+from ios_notifications.models import DeliveryTracker
+from ios_notifications import signals
+
+CONNECTING = 'connecting'
+HANDSHAKING = 'handshaking'
+WRITING = 'writing'
+DRAINING = 'draining'
+DONE = 'done'
+
+
+class NonBlockingPush(object):
+    """
+    Sends one notification to the devices of an APN service over a non-blocking
+    connection. It doesn't block on the socket itself but is advanced by a
+    PushLoop whenever its connection is ready to be read from or written to.
+
+    The payload, frame packing, bookkeeping, pacing and handling of error responses
+    are the same as for APNService.push_notification_to_devices. While a push waits
+    for its throttle it asks the loop to wake it once it can send again.
+    """
+    def __init__(self, service, notification, devices=None, enhanced=None, expiry=None):
+        if devices is None:
+            devices = service.device_set.filter(is_active=True)
+        if enhanced is None:
+            enhanced = getattr(settings, 'IOS_NOTIFICATIONS_ENHANCED_FORMAT', False)
+        if isinstance(expiry, datetime.datetime):
+            expiry = int(time.mktime(expiry.timetuple()))
+        self.service = service
+        self.notification = notification
+        self.enhanced = enhanced
+        self.buffer_size = getattr(settings, 'IOS_NOTIFICATIONS_WRITE_BUFFER_SIZE', 65536)
+        self.timeout = getattr(settings, 'IOS_NOTIFICATIONS_ERROR_RESPONSE_TIMEOUT', 0.5)
+        self.connect_timeout = getattr(settings, 'IOS_NOTIFICATIONS_CONNECT_TIMEOUT', 10)
+        self.frames = FrameBuilder(service.get_payload(notification), enhanced, expiry or 0)
+        self.throttle = service.get_throttle(notification, devices)
+        if self.throttle is not None:
+            self.buffer_size = min(self.buffer_size, max(int(self.throttle.rate // 20), 1) * self.frames.size)
+        self.window = max(getattr(settings, 'IOS_NOTIFICATIONS_RESEND_WINDOW', 5000),
+                          self.buffer_size // self.frames.size + 1)
+        self.tracker = DeliveryTracker()
+        self.result = PushResult()
+        self.rows = iter(service._device_rows(devices, self.tracker))
+        # The first `backlog` rows have been read before and are waiting to be sent again.
+        self.backlog = 0
+        self.blind = None
+        self.context = None
+        self.connection = None
+        self.connected = False
+        self.state = None
+        self.deadline = None
+
+    @property
+    def done(self):
+        return self.state == DONE
+
+    def wants_read(self):
+        return self.state in (HANDSHAKING, WRITING, DRAINING) and self._want_read
+
+    def wants_write(self):
+        return self.state == CONNECTING or (self.state in (HANDSHAKING, WRITING) and self._want_write)
+
+    def connect(self):
+        """
+        Starts connecting to the service without waiting for the connection to be made.
+        """
+        transport = self.service.open_transport()
+        if transport is not None:
+            transport.setblocking(False)
+            self._start(transport)
+            return
+        if self.context is None:
+            self.context = self.service.get_context(self.service.certificate, self.service.private_key,
+                                                    self.service.passphrase)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if sock.connect_ex((self.service.hostname, self.service.PORT)) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            return self._complete()
+        connection = OpenSSL.SSL.Connection(self.context, sock)
+        connection.set_connect_state()
+        self.service.resume_session(connection)
+        self._start(connection)
+
+    def _start(self, connection):
+        self.connection = connection
+        self.state = CONNECTING
+        self.started = time.time()
+        self.deadline = self.started + self.connect_timeout
+        self._want_read = False
+        self._want_write = True
+        self._careful = self.backlog if self.enhanced else 0
+        self._confirming = False
+        self._in_flight = collections.deque()
+        self._packed = 0
+        self._sent = 0
+        self._chunk = ''
+        self._error = ''
+        self._broken = False
+
+    def step(self, readable=False, writable=False):
+        """
+        Does as much work as the connection allows without blocking.
+        """
+        if self.state == CONNECTING:
+            if writable:
+                if self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    return self._complete()
+                self.state = HANDSHAKING
+            elif time.time() >= self.deadline:
+                return self._complete()
+        if self.state == HANDSHAKING:
+            try:
+                self.connection.do_handshake()
+            except OpenSSL.SSL.WantReadError:
+                self._want_read, self._want_write = True, False
+            except OpenSSL.SSL.WantWriteError:
+                self._want_read, self._want_write = False, True
+            except OpenSSL.SSL.Error:
+                return self._complete()
+            else:
+                self.service.save_session(self.connection)
+                signals.service_connected.send(sender=self.service.__class__, service=self.service,
+                                               handshake_time=time.time() - self.started)
+                self.connected = True
+                self.state = WRITING
+                self.deadline = None
+                self._want_read, self._want_write = True, True
+            if self.state == HANDSHAKING:
+                if time.time() >= self.deadline:
+                    self._complete()
+                return
+        if readable:
+            self._read()
+        if self.state == WRITING and (writable or not self._chunk):
+            self._write()
+        if self.state == DRAINING and time.time() >= self.deadline:
+            if self._broken:
+                return self._dropped(None, self._sent // self.frames.size)
+            self.tracker.delivered([row[0] for identifier, row in self._in_flight])
+            self._complete()
+
+    def _read(self):
+        """
+        Reads an error response if one has been sent, noticing if Apple closed the connection.
+        """
+        while self.state in (WRITING, DRAINING):
+            try:
+                data = self.connection.recv(6 - len(self._error))
+            except (OpenSSL.SSL.WantReadError, OpenSSL.SSL.WantWriteError):
+                return
+            except OpenSSL.SSL.Error:
+                data = ''
+            if not data:
+                return self._dropped(None, self._sent // self.frames.size)
+            self._error += data
+            if len(self._error) == 6:
+                command, status, identifier = struct.unpack(self.service.error_response_fmt, self._error)
+                return self._dropped(status, identifier)
+            if not self.connection.pending():
+                return
+
+    def _write(self):
+        """
+        Writes frames until the socket won't accept any more. Frames are only packed
+        once the previous buffer has been written so a slow connection holds back
+        reading devices rather than growing the buffer.
+
+        Frames sent again are written a few at a time as APNService does, each buffer
+        waiting for an error response until its deadline before it is taken as delivered.
+        """
+        while True:
+            if not self._chunk:
+                if self._confirming:
+                    if time.time() < self.deadline:
+                        self._want_write = False
+                        return
+                    self.tracker.delivered([row[0] for identifier, row in self._in_flight])
+                    self._in_flight.clear()
+                    self._confirming = False
+                throttled = self._fill()
+                if throttled:
+                    self._want_write = False
+                    self.deadline = time.time() + self.throttle.delay()
+                    return
+                self._want_write = True
+                self.deadline = None
+                if not self._chunk:
+                    self.state = DRAINING
+                    self.deadline = time.time() + (self.timeout if self.enhanced else 0)
+                    return
+            try:
+                sent = self.connection.send(self._chunk)
+            except (OpenSSL.SSL.WantWriteError, OpenSSL.SSL.WantReadError):
+                self.result.write_retries += 1
+                return
+            except OpenSSL.SSL.Error:
+                # Wait for an error response explaining why the connection was dropped.
+                self._broken = True
+                self.state = DRAINING
+                self.deadline = time.time() + (self.timeout if self.enhanced else 0)
+                return
+            self._chunk = self._chunk[sent:]
+            self._sent += sent
+            if self._confirming:
+                if not self._chunk:
+                    self.deadline = time.time() + self.timeout
+                continue
+            written = self._sent // self.frames.size
+            delivered = []
+            while len(self._in_flight) > self.window and self._in_flight[0][0] < written:
+                delivered.append(self._in_flight.popleft()[1][0])
+            self.tracker.delivered(delivered)
+
+    def _fill(self):
+        """
+        Packs the next buffer of frames.
+
+        returns True if the throttle doesn't allow sending any frames yet.
+        """
+        count = self.buffer_size // self.frames.size + 1
+        careful = self._careful - self._packed
+        if careful > 0:
+            count = min(self.service._resend_size(self.buffer_size, self.frames.size, self.blind), careful)
+        if self.throttle is not None:
+            count = self.throttle.take(count)
+            if not count:
+                return True
+        frames = []
+        for row in itertools.islice(self.rows, count):
+            self._in_flight.append((self._packed, row))
+            frames.append(self.frames.pack(row[1], self._packed))
+            self._packed += 1
+        self._chunk = ''.join(frames)
+        self._confirming = careful > 0 and bool(frames)
+        return False
+
+    def _dropped(self, status, failed):
+        """
+        Handles the connection being closed, reconnecting if there is anything left to send.
+        """
+        written = self._sent // self.frames.size
+        self._close()
+        if status is None:
+            failed, self.blind = self.service._blind_drop(self._in_flight, written, self.enhanced, self.blind)
+        else:
+            self.blind = None
+        if failed is None:
+            retry = [row for identifier, row in self._in_flight]
+        else:
+            retry = self.service._settle(self._in_flight, status, failed, self.tracker, self.result)
+        self._in_flight.clear()
+        self.rows = itertools.chain(retry, self.rows)
+        self.backlog += len(retry)
+        if failed is None or (status is None and written == 0):
+            return self._complete()
+        if not self.backlog:
+            try:
+                self.rows = itertools.chain([self.rows.next()], self.rows)
+            except StopIteration:
+                return self._complete()
+            self.backlog = 1
+        self.result.reconnects += 1
+        self.connect()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        self.backlog = max(self.backlog - self._packed, 0)
+        self.result.frames_written += self._sent // self.frames.size
+        self.result.bytes_written += self._sent - self._sent % self.frames.size
+        try:
+            self.connection.shutdown()
+        except OpenSSL.SSL.Error:
+            pass
+        self.connection.close()
+        self.connection = None
+
+    def _complete(self):
+        self._close()
+        self.result.unsent.extend(row[0] for row in itertools.islice(self.rows, self.backlog))
+        self.state = DONE
+        self.deadline = None
+        self.tracker.flush()
+        if self.connected:
+            self.notification.last_sent_at = datetime.datetime.now()
+            self.notification.save()
+        self.result.finish()
+        if self.connected:
+            signals.push_finished.send(sender=self.service.__class__, service=self.service,
+                                       notification=self.notification, result=self.result)
+
+
+class PushLoop(object):
+    """
+    Sends notifications for many APN services at once from a single thread.
+
+    Every push added to the loop gets its own non-blocking connection and a
+    `select` loop writes to each connection whenever it can take more data,
+    reading error responses as they arrive. This way one thread can keep
+    many pushes in flight instead of tying up a thread for each push.
+    """
+    def __init__(self):
+        self.pushes = []
+
+    def add(self, service, notification, devices=None, enhanced=None, expiry=None):
+        push = NonBlockingPush(service, notification, devices, enhanced, expiry)
+        self.pushes.append(push)
+        return push
+
+    def run(self):
+        """
+        Runs until every push has finished.
+
+        returns a list of ios_notifications.frames.PushResult in the order the pushes were
+        added, or None for pushes which could not connect.
+        """
+        for push in self.pushes:
+            if push.state is None:
+                push.connect()
+        while True:
+            active = [push for push in self.pushes if not push.done]
+            if not active:
+                break
+            readers = [push.connection for push in active if push.wants_read()]
+            writers = [push.connection for push in active if push.wants_write()]
+            deadlines = [push.deadline for push in active if push.deadline is not None]
+            timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+            readable, writable, errored = select.select(readers, writers, [], timeout)
+            for push in active:
+                push.step(push.connection in readable, push.connection in writable)
+        return [push.result if push.connected else None for push in self.pushes]
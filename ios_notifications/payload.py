@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from django.utils import simplejson as json
+from django.utils.encoding import force_unicode
+
+MAX_PAYLOAD_SIZE = 256
+ELLIPSIS = u'\u2026'
+
+# The characters json.dumps escapes when ensure_ascii is False.
+_ESCAPED = dict((unichr(i), 6) for i in range(0x20))
+_ESCAPED.update({u'"': 2, u'\\': 2, u'\n': 2, u'\r': 2, u'\t': 2, u'\b': 2, u'\f': 2})
+
+
+def _encode(value):
+    """
+    Serializes `value` to compact JSON as UTF-8 bytes. Non ASCII characters are
+    written as UTF-8 rather than \\u escapes, which take two or three times the space.
+    """
+    encoded = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+    if isinstance(encoded, unicode):
+        encoded = encoded.encode('utf-8')
+    return encoded
+
+
+def encoded_size(char):
+    """
+    The number of bytes a character takes up in a JSON string encoded by `_encode`.
+    """
+    if char in _ESCAPED:
+        return _ESCAPED[char]
+    code = ord(char)
+    if code < 0x80:
+        return 1
+    elif code < 0x800:
+        return 2
+    elif code < 0x10000:
+        return 3
+    return 4
+
+
+def truncate(text, size, ellipsis=ELLIPSIS):
+    """
+    Returns `text`, or as much of it as fits in `size` encoded bytes followed
+    by `ellipsis`, measuring each character once.
+    """
+    ellipsis_size = sum(encoded_size(char) for char in ellipsis)
+    total = 0
+    cut = 0
+    for i, char in enumerate(text):
+        total += encoded_size(char)
+        if total + ellipsis_size <= size and not u'\ud800' <= char <= u'\udbff':
+            cut = i + 1
+    if total <= size:
+        return text
+    if ellipsis_size > size:
+        return u''
+    return text[:cut] + ellipsis
+
+
+class PayloadEncoder(object):
+    """
+    Encodes aps dictionaries to payloads, measuring their length in UTF-8 bytes.
+
+    With `truncate_alert=True` a string alert which would take the payload over
+    `max_size` is shortened to fit and ends with an ellipsis.
+    """
+    def __init__(self, max_size=MAX_PAYLOAD_SIZE, truncate_alert=False):
+        self.max_size = max_size
+        self.truncate_alert = truncate_alert
+
+    def encode(self, aps):
+        """
+        returns the payload as a byte string, or None if it is longer than the limit.
+        """
+        payload = _encode({'aps': aps})
+        if len(payload) <= self.max_size:
+            return payload
+        alert = aps.get('alert')
+        if not self.truncate_alert or not isinstance(alert, basestring):
+            return None
+        alert = force_unicode(alert)
+        aps = dict(aps, alert=u'')
+        size = self.max_size - len(_encode({'aps': aps}))
+        if size < 0:
+            return None
+        aps['alert'] = truncate(alert, size)
+        return _encode({'aps': aps})
+
+
+class PayloadTemplate(object):
+    """
+    Renders personalized payloads from a base `aps` dictionary.
+
+    Each key of the base dictionary is serialized once when the template is
+    created. Rendering a payload for a device only serializes the keys it
+    overrides, such as a badge count or a localized alert, and joins them with
+    the pre-serialized fragments. The length of the payload is checked against
+    the 256 byte limit as it is rendered.
+    """
+    def __init__(self, aps, max_size=MAX_PAYLOAD_SIZE):
+        self.max_size = max_size
+        self.keys = list(aps.keys())
+        self._fragments = dict((key, self._fragment(key, value)) for key, value in aps.items())
+        self._cache = {}
+
+    def _fragment(self, key, value):
+        return '%s:%s' % (_encode(key), _encode(value))
+
+    def fragment(self, key, value):
+        """
+        Serializes one key of the aps dictionary. Fragments of small immutable
+        values such as badge counts are cached as many devices share them.
+        """
+        try:
+            cache_key = (key, value)
+            fragment = self._cache.get(cache_key)
+        except TypeError:
+            return self._fragment(key, value)
+        if fragment is None:
+            fragment = self._fragment(key, value)
+            if len(self._cache) < 1024:
+                self._cache[cache_key] = fragment
+        return fragment
+
+    def render(self, overrides=None):
+        """
+        Returns the payload with the keys in `overrides` replacing or adding to the base
+        aps dictionary. A value of None removes the key from the payload.
+
+        returns None if the rendered payload would be longer than the limit.
+        """
+        if not overrides:
+            parts = [self._fragments[key] for key in self.keys]
+        else:
+            parts = []
+            for key in self.keys:
+                if key in overrides:
+                    if overrides[key] is not None:
+                        parts.append(self.fragment(key, overrides[key]))
+                else:
+                    parts.append(self._fragments[key])
+            for key, value in overrides.items():
+                if key not in self._fragments and value is not None:
+                    parts.append(self.fragment(key, value))
+        payload = '{"aps":{%s}}' % ','.join(parts)
+        if len(payload) > self.max_size:
+            return None
+        return payload
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, m2m_changed
+
+try:
+    from django.test.signals import setting_changed
+except ImportError:  # Django < 1.4
+    setting_changed = None
+
+from ios_notifications.models import APNService, Device
+from ios_notifications.http import get_serializer
+
+logger = logging.getLogger('ios_notifications')
+
+
+class RegistrationBuffer(object):
+    """
+    Answers repeated registrations of a device from memory and writes them
+    to the database in bulk from a background thread.
+
+    Devices registered with the API are cached for `ttl` seconds, at most
+    `max_size` of them. Registering a cached device again doesn't touch the
+    database: the device is marked as registered in the cache and queued, and
+    the queue is written with chunked UPDATEs setting `is_active` and
+    `last_registered_at` every `interval` seconds, or as soon as `chunk_size`
+    registrations are waiting. Each chunk records the time of its latest
+    registration, which is later than the others by no more than `interval`.
+    Devices deleted meanwhile, for example by another process, are registered
+    again unless their service was deleted too.
+
+    With an `interval` of 0 no thread is started and the queue is written
+    when it fills up or `flush` is called. `stop` writes whatever is queued
+    and is called when the process exits.
+    """
+    def __init__(self, max_size=10000, ttl=300, interval=1.0, chunk_size=500):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def confirm(self, token, service_id):
+        """
+        Registers a cached device again without touching the database.
+
+        returns the serialized device, or None if the device isn't cached.
+        """
+        now = datetime.datetime.now()
+        with self._lock:
+            entry = self._entries.get((token, service_id))
+            if entry is None:
+                return None
+            device, related, expires = entry
+            if expires <= time.time():
+                del self._entries[(token, service_id)]
+                return None
+            device.is_active = True
+            device.last_registered_at = now
+            self._pending[device.pk] = (now, token, service_id)
+            full = len(self._pending) >= self.chunk_size
+        if full:
+            self._wake.set()
+        if self.interval > 0:
+            self._start()
+        elif full:
+            self.flush()
+        return get_serializer(Device).to_dict(device, related)
+
+    def add(self, device):
+        """
+        Caches an active device so it can be registered again from memory.
+        Its users are looked up once, here.
+        """
+        if self.max_size <= 0 or not device.is_active:
+            return
+        serializer = get_serializer(Device)
+        related = serializer.related_ids([device.pk]) if serializer.many_to_many else None
+        key = (device.token, device.service_id)
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                self._evict()
+            self._entries[key] = (device, related, time.time() + self.ttl)
+
+    def discard(self, device):
+        """
+        Forgets a device, for example before it is changed in the database.
+
+        returns when the device was last registered if that is still queued, otherwise None.
+        """
+        with self._lock:
+            self._entries.pop((device.token, device.service_id), None)
+            pending = self._pending.pop(device.pk, None)
+        return pending[0] if pending is not None else None
+
+    def forget(self, device):
+        """
+        Removes a device from the cache, leaving any queued registration of it.
+        """
+        with self._lock:
+            self._entries.pop((device.token, device.service_id), None)
+
+    def flush(self):
+        """
+        Writes the queued registrations. If the database can't be written to
+        they are queued again and the error is raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            ids = sorted(pending, key=pending.get)
+            while ids:
+                chunk, rest = ids[:self.chunk_size], ids[self.chunk_size:]
+                try:
+                    updated = Device.objects.filter(pk__in=chunk).update(
+                        is_active=True, last_registered_at=max(pending[pk][0] for pk in chunk))
+                    if updated < len(chunk):
+                        self._register_deleted(chunk, pending)
+                except Exception:
+                    with self._lock:
+                        for pk in ids:
+                            if pk not in self._pending or self._pending[pk] < pending[pk]:
+                                self._pending[pk] = pending[pk]
+                    raise
+                ids = rest
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def stop(self):
+        """
+        Stops the background thread and writes the queued registrations.
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if entry[2] <= now]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) >= self.max_size:
+            keys = sorted(self._entries, key=lambda key: self._entries[key][2])
+            for key in keys[:max(self.max_size // 10, 1)]:
+                del self._entries[key]
+
+    def _register_deleted(self, chunk, pending):
+        """
+        Registers the devices in `chunk` which no longer exist again, with new ids.
+        """
+        existing = set(Device.objects.filter(pk__in=chunk).values_list('id', flat=True))
+        deleted = [pending[pk] for pk in chunk if pk not in existing]
+        with self._lock:
+            for registered_at, token, service_id in deleted:
+                self._entries.pop((token, service_id), None)
+        services = set(APNService.objects.filter(pk__in=set(entry[2] for entry in deleted))
+                                         .values_list('id', flat=True))
+        for registered_at, token, service_id in deleted:
+            if service_id in services:
+                Device.objects.register(token, service_id)
+
+    def _start(self):
+        if self._thread is not None or self._stopping:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ios_notifications registrations')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning('Could not write %d buffered device registrations: %s', len(self._pending), e)
+
+
+def load_settings(**kwargs):
+    """
+    Reads the write behind settings. They are read once when the module is
+    imported and again whenever a test changes one of them with override_settings,
+    after writing what the previous buffer had queued.
+    """
+    global WRITE_BEHIND, registration_buffer
+    setting = kwargs.get('setting')
+    if setting is not None and not setting.startswith('IOS_NOTIFICATIONS_'):
+        return
+    if kwargs:
+        registration_buffer.stop()
+    WRITE_BEHIND = getattr(settings, 'IOS_NOTIFICATIONS_REGISTRATION_WRITE_BEHIND', False)
+    registration_buffer = RegistrationBuffer(getattr(settings, 'IOS_NOTIFICATIONS_REGISTRATION_CACHE_SIZE', 10000),
+                                             getattr(settings, 'IOS_NOTIFICATIONS_REGISTRATION_CACHE_TTL', 300),
+                                             getattr(settings, 'IOS_NOTIFICATIONS_REGISTRATION_FLUSH_INTERVAL', 1.0),
+                                             getattr(settings, 'IOS_NOTIFICATIONS_BOOKKEEPING_CHUNK_SIZE', 500))
+load_settings()
+
+if setting_changed is not None:
+    setting_changed.connect(load_settings)
+
+
+def shutdown():
+    registration_buffer.stop()
+
+atexit.register(shutdown)
+
+
+def discard_device(sender, instance, **kwargs):
+    registration_buffer.discard(instance)
+
+
+def forget_users(sender, instance, reverse, **kwargs):
+    # The cached devices are serialized with their users.
+    if reverse:
+        registration_buffer.clear()
+    else:
+        registration_buffer.forget(instance)
+
+post_delete.connect(discard_device, sender=Device, dispatch_uid='ios_notifications.registration.delete')
+m2m_changed.connect(forget_users, sender=Device.users.through, dispatch_uid='ios_notifications.registration.users')
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# Sent by an APNService or FeedbackService once a connection has been made.
+# `handshake_time` is the number of seconds taken to connect and complete the TLS handshake.
+service_connected = Signal(providing_args=['service', 'handshake_time'])
+
+# Sent when connecting to a service failed.
+service_connection_failed = Signal(providing_args=['service', 'error'])
+
+# Sent by an APNService after writing a notification to devices over one connection.
+# `result` is the ios_notifications.frames.PushResult for that connection, which includes
+# the frames and bytes written, reconnects, write retries and error responses.
+push_finished = Signal(providing_args=['service', 'notification', 'result'])
+
+# Sent by a DeliveryTracker after writing deliveries and invalid tokens to the database.
+# `duration` is the number of seconds spent on the UPDATEs.
+deliveries_recorded = Signal(providing_args=['delivered', 'invalid', 'duration'])
+
+# Sent by a FeedbackService after deactivating a batch of devices.
+devices_deactivated = Signal(providing_args=['service', 'count'])
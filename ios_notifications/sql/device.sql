@@ -0,0 +1,2 @@
+-- Run by syncdb after the device table is created. Installations using South get this index from migration 0005.
+CREATE INDEX ios_notifications_device_service_id_is_active_id ON ios_notifications_device (service_id, is_active, id);
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import select
+import socket
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+
+import OpenSSL
+
+from ios_notifications.utils import generate_cert_and_pkey
+
+HEADER = struct.Struct('!cH32sH')
+ENHANCED_HEADER = struct.Struct('!cIIH32sH')
+ERROR_RESPONSE = struct.Struct('!cBI')
+FEEDBACK_RECORD = struct.Struct('!lh32s')
+
+
+def listen(host='127.0.0.1', port=0, backlog=5):
+    """
+    Opens an SSL server socket with a self signed certificate.
+    Binding to port 0 picks a free port, which is returned along with the socket.
+    """
+    cert, key = generate_cert_and_pkey(as_string=False)
+    context = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
+    context.use_certificate(cert)
+    context.use_privatekey(key)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock.getsockname()[1], OpenSSL.SSL.Connection(context, sock)
+
+
+class FakeAPNServer(threading.Thread):
+    """
+    A local stand-in for the APN gateway to test and benchmark against.
+
+    It reads frames in both the simple and enhanced formats from any number of
+    connections. Problems can be injected to see how a client copes:
+
+    * `invalid_tokens`: hex tokens which are answered with an INVALID_TOKEN error
+      response before the connection is closed, as Apple does.
+    * `delay`: seconds to wait after every read, to simulate a slow connection.
+    * `disconnect_after`: close each connection without an error response once it
+      has received this many frames.
+    * `disconnects`: only the first this many connections are closed by `disconnect_after`.
+
+    Frames are counted in `frames`. With `record=True` the (identifier, hex token)
+    of every frame is kept in `received` and its payload in `payloads`; for large
+    benchmarks pass `record=False` and an optional `on_frame(identifier, token)`
+    callback instead.
+    """
+    def __init__(self, invalid_tokens=(), delay=0, disconnect_after=None, disconnects=None, record=True,
+                 on_frame=None, host='127.0.0.1', port=0):
+        super(FakeAPNServer, self).__init__()
+        self.daemon = True
+        self.invalid_tokens = set(unhexlify(token) for token in invalid_tokens)
+        self.delay = delay
+        self.disconnect_after = disconnect_after
+        self.disconnects = disconnects
+        self.record = record
+        self.on_frame = on_frame
+        self.received = []
+        self.payloads = []
+        self.frames = 0
+        self.connections = 0
+        self.handlers = []
+        self.running = True
+        self._lock = threading.Lock()
+        self.port, self.server = listen(host, port)
+
+    def run(self):
+        while self.running:
+            if not select.select([self.server], [], [], 0.05)[0]:
+                continue
+            connection, address = self.server.accept()
+            self.connections += 1
+            disconnect = self.disconnects is None or self.connections <= self.disconnects
+            handler = threading.Thread(target=self.handle, args=(connection, disconnect))
+            handler.daemon = True
+            handler.start()
+            self.handlers.append(handler)
+
+    def handle(self, connection, disconnect=True):
+        try:
+            self.receive(connection, disconnect)
+        except OpenSSL.SSL.Error:
+            pass
+        connection.close()
+
+    def receive(self, connection, disconnect=True):
+        buf = ''
+        received = 0
+        while True:
+            try:
+                data = connection.recv(65536)
+            except OpenSSL.SSL.WantReadError:
+                continue
+            if not data:
+                return
+            if self.delay:
+                time.sleep(self.delay)
+            buf += data
+            offset = 0
+            while offset < len(buf):
+                header = ENHANCED_HEADER if buf[offset] == chr(1) else HEADER
+                if len(buf) - offset < header.size:
+                    break
+                fields = header.unpack_from(buf, offset)
+                end = offset + header.size + fields[-1]
+                if len(buf) < end:
+                    break
+                identifier = fields[1] if header is ENHANCED_HEADER else None
+                token = fields[-2]
+                with self._lock:
+                    self.frames += 1
+                    if self.record:
+                        self.received.append((identifier, hexlify(token)))
+                        self.payloads.append(buf[offset + header.size:end])
+                if self.on_frame is not None:
+                    self.on_frame(identifier, token)
+                offset = end
+                received += 1
+                if token in self.invalid_tokens:
+                    connection.sendall(ERROR_RESPONSE.pack(chr(8), 8, identifier or 0))
+                    connection.shutdown()
+                    return
+                if disconnect and self.disconnect_after is not None and received >= self.disconnect_after:
+                    return
+            buf = buf[offset:]
+
+    def stop(self):
+        """
+        Stops accepting connections and waits for open connections to be closed by the client.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.join(1)
+        for handler in self.handlers:
+            handler.join(1)
+        self.server.close()
+
+
+class FakeFeedbackServer(threading.Thread):
+    """
+    A local stand-in for the feedback service which sends `records`, an iterable of
+    (timestamp, hex token) tuples, to the first client to connect and then closes the connection.
+
+    The records are written `chunk_size` bytes at a time, so small chunks exercise a
+    client's handling of short reads, with `delay` seconds between writes.
+    With `disconnect=True` the connection is dropped without a TLS shutdown.
+    """
+    def __init__(self, records, chunk_size=25, delay=0, disconnect=False, host='127.0.0.1', port=0):
+        super(FakeFeedbackServer, self).__init__()
+        self.daemon = True
+        self.records = records
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.disconnect = disconnect
+        self.port, self.server = listen(host, port, 1)
+
+    def run(self):
+        connection, address = self.server.accept()
+        try:
+            buf = ''
+            for timestamp, token in self.records:
+                buf += FEEDBACK_RECORD.pack(timestamp, 32, unhexlify(token))
+                while len(buf) >= self.chunk_size:
+                    self.send(connection, buf[:self.chunk_size])
+                    buf = buf[self.chunk_size:]
+            if buf:
+                self.send(connection, buf)
+            if not self.disconnect:
+                connection.shutdown()
+        except OpenSSL.SSL.Error:
+            pass
+        connection.close()
+        self.server.close()
+
+    def send(self, connection, data):
+        connection.sendall(data)
+        if self.delay:
+            time.sleep(self.delay)
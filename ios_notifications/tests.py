@@ -1,22 +1,40 @@
 # -*- coding: utf-8 -*-
+import socket
 import subprocess
+import tempfile
 import time
 import struct
 import os
 import datetime
+from binascii import unhexlify
+from StringIO import StringIO
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.utils import simplejson as json
 from django.http import HttpResponseNotAllowed
 from django.conf import settings
-from django.core import management
+from django.core import management, serializers
+from django.db import connection
 
-from ios_notifications.models import APNService, Device, Notification, NotificationPayloadSizeExceeded
+import OpenSSL
+
+from ios_notifications.models import APNService, Device, Notification, NotificationPayloadSizeExceeded, DeviceStream, \
+    DeliveryTracker, NotificationJob, FeedbackService
 from ios_notifications.http import JSONResponse
+from ios_notifications import decorators, metrics, registration, signals
 from ios_notifications.utils import generate_cert_and_pkey
-from ios_notifications.forms import APNServiceForm
+from ios_notifications.fields import pack_token
+from ios_notifications.forms import APNServiceForm, DeviceRegistrationForm
+from ios_notifications.connections import connection_pool, context_cache
+from ios_notifications.frames import FrameBuilder, FrameWriter
+from ios_notifications.nonblocking import PushLoop
+from ios_notifications.payload import PayloadTemplate
+from ios_notifications.throttle import TokenBucket, Throttle
+from ios_notifications.dispatch import dispatch, copy_notification
+from ios_notifications.testing import FakeAPNServer, FakeFeedbackServer
 
 TOKEN = '0fd12510cfe6b0a4a89dc7369c96df956f991e66131dab63398734e8000d0029'
 TEST_PEM = os.path.abspath(os.path.join(os.path.dirname(__file__), 'test.pem'))
@@ -24,6 +42,41 @@ TEST_PEM = os.path.abspath(os.path.join(os.path.dirname(__file__), 'test.pem'))
 SSL_SERVER_COMMAND = ('openssl', 's_server', '-accept', '2195', '-cert', TEST_PEM)
 
 
+def use_authentication(test, auth_type, **extra):
+    """
+    Overrides IOS_NOTIFICATIONS_AUTHENTICATION (and any `extra` settings) until the test finishes.
+    The decorators module reads these settings once and reloads them when they are overridden.
+    """
+    extra['IOS_NOTIFICATIONS_AUTHENTICATION'] = auth_type
+    override = override_settings(**extra)
+    override.enable()
+    test.addCleanup(override.disable)
+
+
+class RecordingConnection(object):
+    """
+    Records what is written to it. The first `stalls` writes fail as a full
+    non-blocking socket would, and the file it selects on is always writable.
+    """
+    def __init__(self, stalls=0):
+        self.writes = []
+        self.stalls = stalls
+        self.file = tempfile.TemporaryFile()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def send(self, data):
+        if self.stalls:
+            self.stalls -= 1
+            raise OpenSSL.SSL.WantWriteError()
+        self.writes.append(data)
+        return len(data)
+
+
 class APNServiceTest(TestCase):
     def setUp(self):
         self.test_server_proc = subprocess.Popen(SSL_SERVER_COMMAND, stdout=subprocess.PIPE)
@@ -44,6 +97,25 @@ class APNServiceTest(TestCase):
         n = Notification(message='.' * 260)
         self.assertRaises(NotificationPayloadSizeExceeded, self.service.get_payload, n)
 
+    def test_payload_size_is_measured_in_utf8_bytes(self):
+        self.assertTrue(Notification.is_valid_length(u'\u00e9' * 100))
+        self.assertFalse(Notification.is_valid_length(u'\u20ac' * 80))
+        n = Notification(message=u'\u00e9' * 100)
+        payload = self.service.get_payload(n)
+        self.assertEqual(json.loads(payload)['aps']['alert'], n.message)
+        self.assertIs(self.service.get_payload(n), payload)
+        n.badge = 2
+        self.assertEqual(json.loads(self.service.get_payload(n))['aps']['badge'], 2)
+
+    def test_payload_alert_is_truncated_to_fit(self):
+        n = Notification(message=u'\u20ac"' * 60)
+        self.assertRaises(NotificationPayloadSizeExceeded, self.service.get_payload, n)
+        payload = self.service.get_payload(n, truncate=True)
+        alert = json.loads(payload)['aps']['alert']
+        self.assertTrue(252 < len(payload) <= 256)
+        self.assertTrue(alert.endswith(u'\u2026'))
+        self.assertTrue(n.message.startswith(alert[:-1]))
+
     def test_payload_packed_correctly(self):
         fmt = self.service.fmt
         payload = self.service.get_payload(self.notification)
@@ -61,6 +133,438 @@ class APNServiceTest(TestCase):
         self.assertIsNotNone(self.notification.last_sent_at)
         self.assertIsNotNone(self.device.last_notified_at)
 
+    def test_persistent_connection_is_reused(self):
+        self.service.push_notification_to_devices(self.notification, [self.device])
+        self.assertIsNone(self.service.connection)
+        self.assertEqual(connection_pool.idle_count(self.service), 1)
+        self.assertTrue(connection_pool.acquire(self.service))
+        connection = self.service.connection
+        connection_pool.release(self.service)
+        self.service.push_notification_to_devices(self.notification, [self.device])
+        self.assertEqual(connection_pool.idle_count(self.service), 1)
+        self.assertTrue(connection_pool.acquire(self.service))
+        self.assertTrue(self.service.connection is connection)
+        connection_pool.release(self.service)
+        connection_pool.close_all()
+        self.assertEqual(connection_pool.idle_count(), 0)
+
+    def test_ssl_context_is_cached_until_credentials_change(self):
+        context = self.service.get_context(self.service.certificate, self.service.private_key)
+        self.assertTrue(self.service.get_context(self.service.certificate, self.service.private_key) is context)
+        self.assertTrue(self.service.connect())
+        self.service.disconnect()
+        address = (self.service.hostname, APNService.PORT)
+        self.assertIsNotNone(context_cache.get_session(self.service.get_context_key(), address))
+        cert, key = generate_cert_and_pkey(passphrase='pass')
+        form = APNServiceForm({'name': self.service.name, 'hostname': self.service.hostname,
+                               'certificate': cert, 'private_key': key, 'passphrase': 'pass'}, instance=self.service)
+        service = form.save()
+        self.assertIsNone(context_cache.get_session(service.get_context_key(), address))
+        self.assertFalse(service.get_context(service.certificate, service.private_key, service.passphrase) is context)
+
+    def test_enhanced_payload_packed_correctly(self):
+        payload = self.service.get_payload(self.notification)
+        msg = self.service.pack_message(payload, self.device, 7, 100)
+        unpacked = struct.unpack(self.service.enhanced_fmt % len(payload), msg)
+        self.assertEqual(unpacked[:3], (chr(1), 7, 100))
+        self.assertEqual(unpacked[-1], payload)
+
+    def test_frame_builder_packs_many_devices(self):
+        payload = self.service.get_payload(self.notification)
+        other = Device(token='1' * 64, service=self.service)
+        frames = FrameBuilder(payload)
+        buf = frames.pack_many([unhexlify(self.device.token), unhexlify(other.token)])
+        self.assertEqual(len(buf), frames.size * 2)
+        self.assertEqual(buf, self.service.pack_message(payload, self.device) + self.service.pack_message(payload, other))
+        frames = FrameBuilder(payload, enhanced=True, expiry=100)
+        buf = frames.pack_many([unhexlify(self.device.token), unhexlify(other.token)], 5)
+        self.assertEqual(buf[frames.size:], self.service.pack_message(payload, other, 6, 100))
+
+    def test_frame_writer_coalesces_frames(self):
+        connection = RecordingConnection()
+        writer = FrameWriter(connection, buffer_size=10)
+        self.assertFalse(writer.write('a' * 4))
+        self.assertTrue(writer.write('b' * 6))
+        self.assertFalse(writer.write('c' * 4))
+        self.assertEqual(connection.writes, ['aaaabbbbbb'])
+        self.assertEqual((writer.frames_written, writer.bytes_written), (2, 10))
+        writer.flush()
+        self.assertEqual(connection.writes, ['aaaabbbbbb', 'cccc'])
+        self.assertEqual((writer.frames_written, writer.bytes_written), (3, 14))
+
+    def test_frame_writer_counts_writes_which_had_to_wait(self):
+        connection = RecordingConnection(stalls=2)
+        writer = FrameWriter(connection, buffer_size=10)
+        self.assertTrue(writer.write('a' * 10))
+        self.assertEqual(connection.writes, ['a' * 10])
+        self.assertEqual((writer.frames_written, writer.write_retries), (1, 2))
+
+    def test_connection_failure_is_signalled_when_nothing_is_listening(self):
+        failures = []
+
+        def record_failure(sender, service, error, **kwargs):
+            failures.append(service)
+        signals.service_connection_failed.connect(record_failure)
+        self.addCleanup(signals.service_connection_failed.disconnect, record_failure)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.service.PORT = sock.getsockname()[1]
+        sock.close()
+        self.assertFalse(self.service.connect())
+        self.assertEqual(failures, [self.service])
+
+    def test_push_result_reports_frames_written(self):
+        payload = self.service.get_payload(self.notification)
+        result = self.service.push_notification_to_devices(self.notification, [self.device])
+        self.assertEqual(result.frames_written, 1)
+        self.assertEqual(result.bytes_written, len(self.service.pack_message(payload, self.device)))
+
+    def test_device_stream_yields_chunks_in_id_order(self):
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        stream = DeviceStream(self.service.device_set.all(), chunk_size=2)
+        self.assertEqual(list(stream), [(d.id, d.token) for d in devices])
+        self.assertEqual(stream.last_id, devices[-1].id)
+        stream = DeviceStream(self.service.device_set.all(), chunk_size=2, last_id=devices[2].id)
+        self.assertEqual(list(stream), [(d.id, d.token) for d in devices[3:]])
+
+    def test_broadcast_streams_devices_and_skips_rejected_device(self):
+        server = FakeAPNServer(invalid_tokens=['1' * 64])
+        server.start()
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification, enhanced=True)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual([token for identifier, token in server.received], [d.token for d in devices])
+        self.assertEqual(result.errors, [(APNService.INVALID_TOKEN, devices[2].id)])
+        self.assertEqual(result.reconnects, 1)
+        notified = Device.objects.filter(last_notified_at__isnull=False)
+        self.assertEqual(set(notified.values_list('id', flat=True)), set(d.id for d in devices) - set([devices[2].id]))
+
+    def test_dropped_connection_without_error_response_resends_frames_in_flight(self):
+        server = FakeAPNServer(disconnect_after=20, disconnects=2)
+        server.start()
+        devices = [self.device] + [Device.objects.create(token='%064x' % i, service=self.service) for i in range(49)]
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification, enhanced=True)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual(set(token for identifier, token in server.received), set(d.token for d in devices))
+        self.assertEqual(result.reconnects, 2)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 50)
+
+    def push_with_invalid_tokens(self, push):
+        """
+        Calls `push` with 30 devices, four of them with invalid tokens spread across several
+        buffers, and checks every device was sent the notification once.
+        """
+        devices = [self.device] + [Device.objects.create(token='%064x' % i, service=self.service) for i in range(29)]
+        invalid = [devices[i] for i in (5, 14, 16, 25)]
+        size = FrameBuilder(self.service.get_payload(self.notification), enhanced=True).size
+        server = FakeAPNServer(invalid_tokens=[d.token for d in invalid])
+        server.start()
+        try:
+            self.service.PORT = server.port
+            with override_settings(IOS_NOTIFICATIONS_WRITE_BUFFER_SIZE=size * 8,
+                                   IOS_NOTIFICATIONS_RESEND_BUFFER_SIZE=size * 3,
+                                   IOS_NOTIFICATIONS_ERROR_RESPONSE_TIMEOUT=0.05):
+                result = push()
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual(sorted(token for identifier, token in server.received), sorted(d.token for d in devices))
+        self.assertEqual(result.errors, [(APNService.INVALID_TOKEN, d.id) for d in invalid])
+        self.assertEqual(result.unsent, [])
+        self.assertEqual(set(Device.objects.filter(is_active=False)), set(invalid))
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 26)
+
+    def test_frames_after_a_rejected_frame_are_sent_again_once(self):
+        self.push_with_invalid_tokens(lambda: self.service.push_notification_to_devices(self.notification, enhanced=True))
+
+    def test_push_loop_sends_frames_after_a_rejected_frame_again_once(self):
+        def push():
+            loop = PushLoop()
+            loop.add(self.service, self.notification, enhanced=True)
+            return loop.run()[0]
+        self.push_with_invalid_tokens(push)
+
+    @override_settings(IOS_NOTIFICATIONS_ERROR_RESPONSE_TIMEOUT=0.05)
+    def test_push_gives_up_when_always_dropped_without_error_response(self):
+        server = FakeAPNServer(disconnect_after=1)
+        server.start()
+        devices = [self.device] + [Device.objects.create(token='%064x' % i, service=self.service) for i in range(9)]
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification, enhanced=True)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual(result.reconnects, APNService.MAX_BLIND_RESENDS)
+        self.assertEqual(result.unsent, [d.id for d in devices])
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 0)
+
+    def test_push_loop_resends_frames_in_flight_when_dropped_without_error_response(self):
+        server = FakeAPNServer(disconnect_after=20, disconnects=2)
+        server.start()
+        devices = [self.device] + [Device.objects.create(token='%064x' % i, service=self.service) for i in range(49)]
+        try:
+            self.service.PORT = server.port
+            loop = PushLoop()
+            loop.add(self.service, self.notification, enhanced=True)
+            results = loop.run()
+        finally:
+            server.stop()
+        self.assertEqual(set(token for identifier, token in server.received), set(d.token for d in devices))
+        self.assertEqual(results[0].reconnects, 2)
+
+    def test_malformed_tokens_are_skipped(self):
+        server = FakeAPNServer()
+        server.start()
+        devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(3)]
+        Device.objects.filter(pk=devices[1].pk).update(token='not a token', token_bin=None)
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification)
+            rows = [(1, '1' * 63), (2, '2' * 64)]
+            self.service.push_notification_to_devices(self.notification, iter(rows))
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual([token for identifier, token in server.received],
+                         [TOKEN, devices[0].token, devices[2].token, '2' * 64])
+        self.assertEqual(result.frames_written, 3)
+
+    def test_quarantine_malformed_devices(self):
+        devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        user = User.objects.create(username='user')
+        devices[2].users.add(user)
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+        # Migration 0005 packed the tokens as they were stored, without normalizing them first.
+        for device, token in zip(devices, ['<' + 'AB' * 32 + '>', 'xyz', TOKEN.upper(), 'CD' * 32]):
+            Device.objects.filter(pk=device.pk).update(token=token, token_bin=pack_token(token))
+        out = StringIO()
+        management.call_command('quarantine_ios_devices', stdout=out)
+        self.assertEqual(out.getvalue(), '2 device tokens were fixed, 1 duplicate device was merged, '
+                                         '1 malformed device was deactivated.\n')
+        fixed = Device.objects.get(pk=devices[0].pk)
+        self.assertEqual((fixed.token, fixed.token_bin, fixed.is_active), ('ab' * 32, unhexlify('ab' * 32), True))
+        self.assertFalse(Device.objects.get(pk=devices[1].pk).is_active)
+        self.assertFalse(Device.objects.filter(pk=devices[2].pk).exists())
+        merged = Device.objects.get(pk=self.device.pk)
+        self.assertTrue(merged.is_active)
+        self.assertEqual(list(merged.users.all()), [user])
+        self.assertEqual(Device.objects.get(pk=devices[3].pk).token, 'cd' * 32)
+        self.assertEqual(Device.objects.filter_token(TOKEN).count(), 1)
+
+    def test_push_to_users_sends_to_each_device_once(self):
+        server = FakeAPNServer()
+        server.start()
+        users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        devices[0].users.add(users[0], users[2])
+        devices[1].users.add(users[1])
+        devices[2].users.add(users[2])
+        devices[3].users.add(users[0])
+        Device.objects.filter(pk=devices[3].pk).update(is_active=False)
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_to_users(self.notification, (user.id for user in users), chunk_size=2)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual(sorted(token for identifier, token in server.received), [d.token for d in devices[:3]])
+        self.assertEqual(result.frames_written, 3)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 3)
+
+    def test_push_records_metrics(self):
+        class RecordingBackend(metrics.MetricsBackend):
+            def __init__(self):
+                self.timings, self.counts = {}, {}
+
+            def timing(self, name, seconds):
+                self.timings[name] = seconds
+
+            def incr(self, name, value=1):
+                self.counts[name] = self.counts.get(name, 0) + value
+
+        backend = RecordingBackend()
+        metrics.install(backend)
+        self.addCleanup(metrics.install)
+        server = FakeAPNServer()
+        server.start()
+        for i in range(2):
+            Device.objects.create(token=str(i) * 64, service=self.service)
+        try:
+            self.service.PORT = server.port
+            self.service.push_notification_to_devices(self.notification)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertIn('ios_notifications.apn.test-service.handshake', backend.timings)
+        self.assertIn('ios_notifications.apn.test-service.push', backend.timings)
+        self.assertEqual(backend.counts['ios_notifications.apn.test-service.frames'], 3)
+        self.assertEqual(backend.counts['ios_notifications.delivered'], 3)
+
+    def test_payload_template_renders_overrides(self):
+        template = PayloadTemplate({'alert': 'Hello', 'badge': 1, 'sound': 'default'})
+        self.assertEqual(json.loads(template.render({'badge': 5, 'sound': None})), {'aps': {'alert': 'Hello', 'badge': 5}})
+        self.assertEqual(json.loads(template.render()), {'aps': {'alert': 'Hello', 'badge': 1, 'sound': 'default'}})
+        self.assertEqual(json.loads(template.render({'content-available': 1}))['aps']['content-available'], 1)
+        self.assertIsNone(template.render({'alert': '.' * 256}))
+
+    def test_push_personalized_sends_each_device_its_payload(self):
+        server = FakeAPNServer(invalid_tokens=['1' * 64])
+        server.start()
+        devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        pairs = [(devices[0], {'badge': 3}), ((devices[1].id, devices[1].token), {'alert': u'Bonjour'}),
+                 (devices[2], {'alert': '.' * 256}), (devices[3], None)]
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_personalized(self.notification, pairs, enhanced=True)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual([token for identifier, token in server.received], [d.token for d in (devices[0], devices[1], devices[3])])
+        payloads = [json.loads(payload)['aps'] for payload in server.payloads]
+        self.assertEqual([(aps['alert'], aps['badge']) for aps in payloads],
+                         [('Test message', 3), ('Bonjour', 1), ('Test message', 1)])
+        self.assertEqual(result.errors, [(APNService.INVALID_TOKEN, devices[1].id), (APNService.INVALID_PAYLOAD_SIZE, devices[2].id)])
+
+    def test_delivery_tracker_writes_in_chunks(self):
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(4)]
+        tracker = DeliveryTracker(autoflush=False)
+        tracker.chunk_size = 2
+        tracker.watch([self.device])
+        tracker.delivered([d.id for d in devices[:4]])
+        tracker.invalid(devices[4].id)
+        self.assertFalse(Device.objects.filter(last_notified_at__isnull=False).exists())
+        tracker.flush()
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 4)
+        self.assertFalse(Device.objects.get(pk=devices[4].pk).is_active)
+        self.assertIsNotNone(self.device.last_notified_at)
+
+    def test_delivery_tracking_can_be_turned_off(self):
+        setattr(settings, 'IOS_NOTIFICATIONS_TRACK_LAST_NOTIFIED', False)
+        try:
+            self.service.push_notification_to_devices(self.notification)
+        finally:
+            del settings.IOS_NOTIFICATIONS_TRACK_LAST_NOTIFIED
+        self.assertIsNone(Device.objects.get(pk=self.device.pk).last_notified_at)
+        self.assertIsNotNone(self.notification.last_sent_at)
+
+    def test_broadcast_over_several_connections(self):
+        server = FakeAPNServer(invalid_tokens=['3' * 64])
+        server.start()
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(8)]
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification, enhanced=True, workers=3)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        self.assertEqual(sorted(token for identifier, token in server.received), sorted(d.token for d in devices))
+        self.assertTrue(server.connections >= 3)
+        self.assertTrue(result.frames_written >= len(devices))
+        self.assertEqual(result.errors, [(APNService.INVALID_TOKEN, devices[4].id)])
+        self.assertFalse(Device.objects.get(pk=devices[4].pk).is_active)
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), len(devices) - 1)
+        self.assertIsNotNone(self.notification.last_sent_at)
+
+    def test_broadcast_reports_devices_of_a_worker_which_could_not_connect_as_unsent(self):
+        server = FakeAPNServer()
+        server.start()
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(8)]
+        connect = APNService.connect
+        attempts = []
+
+        def refuse_second_connection(service):
+            attempts.append(service)
+            return len(attempts) != 2 and connect(service)
+        APNService.connect = refuse_second_connection
+        try:
+            self.service.PORT = server.port
+            result = self.service.push_notification_to_devices(self.notification, enhanced=True, workers=3)
+        finally:
+            APNService.connect = connect
+            connection_pool.close_all()
+            server.stop()
+        sent = set(token for identifier, token in server.received)
+        self.assertEqual(len(sent), 6)
+        self.assertEqual(result.unsent, sorted(d.id for d in devices if d.token not in sent))
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 6)
+
+    def test_push_loop_sends_for_several_services(self):
+        servers = [FakeAPNServer(invalid_tokens=['1' * 64]), FakeAPNServer()]
+        cert, key = generate_cert_and_pkey()
+        other = APNService.objects.create(name='other-service', hostname='127.0.0.1', certificate=cert, private_key=key)
+        other_notification = Notification.objects.create(message='Other message', service=other)
+        devices = [self.device] + [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(3)]
+        other_devices = [Device.objects.create(token=str(i) * 64, service=other) for i in range(5)]
+        for server in servers:
+            server.start()
+        try:
+            self.service.PORT = servers[0].port
+            other.PORT = servers[1].port
+            loop = PushLoop()
+            loop.add(self.service, self.notification, enhanced=True)
+            loop.add(other, other_notification, enhanced=True)
+            results = loop.run()
+        finally:
+            for server in servers:
+                server.stop()
+        self.assertEqual([token for identifier, token in servers[0].received], [d.token for d in devices])
+        self.assertEqual([token for identifier, token in servers[1].received], [d.token for d in other_devices])
+        self.assertEqual(results[0].errors, [(APNService.INVALID_TOKEN, devices[2].id)])
+        self.assertEqual(results[1].frames_written, len(other_devices))
+        self.assertFalse(Device.objects.get(pk=devices[2].pk).is_active)
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 8)
+        self.assertIsNotNone(Notification.objects.get(pk=other_notification.pk).last_sent_at)
+
+    def test_push_loop_waits_for_rate_limit(self):
+        server = FakeAPNServer()
+        server.start()
+        for i in range(5):
+            Device.objects.create(token=str(i) * 64, service=self.service)
+        self.service.rate_limit = 20
+        try:
+            self.service.PORT = server.port
+            loop = PushLoop()
+            loop.add(self.service, self.notification)
+            started = time.time()
+            results = loop.run()
+            elapsed = time.time() - started
+        finally:
+            server.stop()
+        self.assertEqual(results[0].frames_written, 6)
+        self.assertEqual(server.frames, 6)
+        self.assertTrue(elapsed >= 0.15)
+
+    def test_enhanced_format_resumes_after_rejected_device(self):
+        server = FakeAPNServer(invalid_tokens=[TOKEN])
+        server.start()
+        try:
+            self.service.PORT = server.port
+            first = Device.objects.create(token='1' * 64, service=self.service)
+            last = Device.objects.create(token='2' * 64, service=self.service)
+            self.service.push_notification_to_devices(self.notification, [first, self.device, last], enhanced=True)
+        finally:
+            connection_pool.close_all()
+            server.stop()
+        tokens = [token for identifier, token in server.received]
+        self.assertEqual(tokens, [first.token, TOKEN, last.token])
+        self.assertEqual(server.received[-1][0], 0)
+        self.assertEqual(server.connections, 2)
+        self.assertFalse(Device.objects.get(pk=self.device.pk).is_active)
+        self.assertIsNotNone(Device.objects.get(pk=first.pk).last_notified_at)
+        self.assertIsNotNone(Device.objects.get(pk=last.pk).last_notified_at)
+        self.assertIsNone(Device.objects.get(pk=self.device.pk).last_notified_at)
+
     def test_create_with_passphrase(self):
         cert, key = generate_cert_and_pkey(as_string=True, passphrase='pass')
         form = APNServiceForm({'name': 'test', 'hostname': 'localhost', 'certificate': cert, 'private_key': key, 'passphrase': 'pass'})
@@ -73,6 +577,7 @@ class APNServiceTest(TestCase):
         self.assertTrue('passphrase' in form.errors)
 
     def tearDown(self):
+        connection_pool.close_all()
         self.test_server_proc.kill()
 
 
@@ -82,8 +587,7 @@ class APITest(TestCase):
         self.service = APNService.objects.create(name='sandbox', hostname='gateway.sandbox.push.apple.com')
         self.device_token = TOKEN
         self.user = User.objects.create(username='testuser', email='test@example.com')
-        self.AUTH = getattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'NotSpecified')
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthNone')
+        use_authentication(self, 'AuthNone')
         self.device = Device.objects.create(service=self.service, token='0fd12510cfe6b0a4a89dc7369d96df956f991e66131dab63398734e8000d0029')
 
     def test_register_device_invalid_params(self):
@@ -114,6 +618,146 @@ class APITest(TestCase):
         device_json = json.loads(content)
         self.assertEqual(device_json.get('model'), 'ios_notifications.device')
 
+    def test_register_device_with_unknown_service(self):
+        resp = self.client.post(reverse('ios-notifications-device-create'),
+                                {'token': self.device_token, 'service': self.service.id + 1})
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue('service' in json.loads(resp.content))
+        resp = self.client.post(reverse('ios-notifications-device-bulk'),
+                                {'token': [self.device_token], 'service': self.service.id + 1})
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue('service' in json.loads(resp.content))
+        self.assertEqual(Device.objects.count(), 1)
+
+    def test_device_token_is_looked_up_in_binary(self):
+        self.assertEqual(Device.objects.get(pk=self.device.pk).token_bin, unhexlify(self.device.token))
+        self.assertEqual(list(Device.objects.filter_token(self.device.token.upper())), [self.device])
+        resp = self.client.post(reverse('ios-notifications-device-create'),
+                                {'token': self.device.token, 'service': self.service.id})
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse('token_bin' in json.loads(resp.content)['fields'])
+
+    def test_register_existing_device_reactivates_it(self):
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+        # The existing device is updated and read back without trying to insert it first.
+        with self.assertNumQueries(2):
+            device, created = Device.objects.register(self.device.token, self.service.id)
+        self.assertEqual((device.pk, device.is_active, created), (self.device.pk, True, False))
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+        resp = self.client.post(reverse('ios-notifications-device-create'),
+                                {'token': self.device.token, 'service': self.service.id})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['pk'], self.device.pk)
+        device = Device.objects.get(pk=self.device.pk)
+        self.assertTrue(device.is_active)
+        self.assertIsNotNone(device.last_registered_at)
+
+    def test_bulk_register_devices(self):
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+        tokens = [self.device.token, '1' * 64, '2' * 64, '1' * 64]
+        resp = self.client.post(reverse('ios-notifications-device-bulk'), {'token': tokens, 'service': self.service.id})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content), {'created': 2, 'activated': 1})
+        self.assertEqual(Device.objects.filter(service=self.service, is_active=True).count(), 3)
+        resp = self.client.post(reverse('ios-notifications-device-bulk'), {'service': self.service.id})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(reverse('ios-notifications-device-bulk'), {'token': ['1' * 63], 'service': self.service.id})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_device_token_is_normalized(self):
+        form = DeviceRegistrationForm({'token': '<%s>' % ' '.join([TOKEN.upper()[i:i + 8] for i in range(0, 64, 8)]),
+                                       'service': self.service.id})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['token'], TOKEN)
+        for token in ('1' * 63, 'g' * 64, ''):
+            self.assertFalse(DeviceRegistrationForm({'token': token, 'service': self.service.id}).is_valid())
+        device = Device.objects.create(token='2' * 32 + 'A' * 32, service=self.service)
+        self.assertEqual(device.token, '2' * 32 + 'a' * 32)
+        self.assertEqual(Device.objects.filter_token('2' * 32 + 'A' * 32).get(), device)
+
+    def test_json_response_matches_django_serializer(self):
+        self.device.users.add(self.user)
+        self.device.last_notified_at = datetime.datetime(2013, 1, 2, 3, 4, 5, 678901)
+        self.device.save()
+        expected = json.loads(serializers.serialize('json', [self.device]))
+        self.assertEqual(json.loads(JSONResponse(self.device).content), expected[0])
+        Device.objects.create(service=self.service, token='1' * 64)
+        devices = Device.objects.order_by('id')
+        resp = JSONResponse(devices)
+        self.assertEqual(json.loads(resp.content), json.loads(serializers.serialize('json', devices)))
+
+    def test_write_behind_registration(self):
+        use_authentication(self, 'AuthNone', IOS_NOTIFICATIONS_REGISTRATION_WRITE_BEHIND=True,
+                           IOS_NOTIFICATIONS_REGISTRATION_FLUSH_INTERVAL=0)
+        buffer = registration.registration_buffer
+        url = reverse('ios-notifications-device-create')
+        data = {'token': self.device.token, 'service': self.service.id}
+        resp = self.client.post(url, data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(buffer), 1)
+        Device.objects.filter(pk=self.device.pk).update(is_active=False, last_registered_at=None)
+        with self.assertNumQueries(0):
+            resp = self.client.post(url, data)
+        self.assertEqual(resp.status_code, 200)
+        content = json.loads(resp.content)
+        self.assertEqual(content['pk'], self.device.pk)
+        self.assertTrue(content['fields']['is_active'])
+        self.assertFalse(Device.objects.get(pk=self.device.pk).is_active)
+        buffer.flush()
+        device = Device.objects.get(pk=self.device.pk)
+        self.assertTrue(device.is_active)
+        self.assertIsNotNone(device.last_registered_at)
+
+    def test_write_behind_registration_of_deleted_device(self):
+        use_authentication(self, 'AuthNone', IOS_NOTIFICATIONS_REGISTRATION_WRITE_BEHIND=True,
+                           IOS_NOTIFICATIONS_REGISTRATION_FLUSH_INTERVAL=0)
+        buffer = registration.registration_buffer
+        url = reverse('ios-notifications-device-create')
+        data = {'token': self.device.token, 'service': self.service.id}
+        self.client.post(url, data)
+        # Deleted by another process, so no signal tells the cache.
+        connection.cursor().execute('DELETE FROM ios_notifications_device WHERE id = %s', [self.device.pk])
+        self.assertEqual(self.client.post(url, data).status_code, 200)
+        buffer.flush()
+        device = Device.objects.get()
+        self.assertEqual(device.token, self.device.token)
+        self.assertTrue(device.is_active)
+        self.assertEqual(len(buffer), 0)
+
+    def test_write_behind_registration_is_written_before_updates(self):
+        use_authentication(self, 'AuthNone', IOS_NOTIFICATIONS_REGISTRATION_WRITE_BEHIND=True,
+                           IOS_NOTIFICATIONS_REGISTRATION_FLUSH_INTERVAL=0)
+        buffer = registration.registration_buffer
+        url = reverse('ios-notifications-device-create')
+        data = {'token': self.device.token, 'service': self.service.id}
+        self.client.post(url, data)
+        Device.objects.filter(pk=self.device.pk).update(is_active=False, last_registered_at=None)
+        self.client.post(url, data)
+        kwargs = {'token': self.device.token, 'service__id': self.service.id}
+        resp = self.client.put(reverse('ios-notifications-device', kwargs=kwargs), 'platform=iPad',
+                               content_type='application/x-www-form-urlencode')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(buffer), 0)
+        device = Device.objects.get(pk=self.device.pk)
+        self.assertEqual(device.platform, 'iPad')
+        self.assertTrue(device.is_active)
+        self.assertIsNotNone(device.last_registered_at)
+        with self.assertNumQueries(0):
+            buffer.flush()
+
+        # Registering again goes to the database, which is then cached, and queued registrations are
+        # written when the settings change as they would be when the process exits.
+        self.assertEqual(self.client.post(url, data).status_code, 200)
+        self.assertTrue(Device.objects.get(pk=self.device.pk).is_active)
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+        self.client.post(url, data)
+        self.device.users.add(self.user)
+        self.assertEqual(len(buffer), 0)
+        override = override_settings(IOS_NOTIFICATIONS_REGISTRATION_CACHE_TTL=60)
+        override.enable()
+        override.disable()
+        self.assertTrue(Device.objects.get(pk=self.device.pk).is_active)
+
     def test_disallowed_method(self):
         resp = self.client.delete(reverse('ios-notifications-device-create'))
         self.assertEqual(resp.status_code, 405)
@@ -139,12 +783,6 @@ class APITest(TestCase):
         device_json = json.loads(content)
         self.assertEqual(device_json.get('model'), 'ios_notifications.device')
 
-    def tearDown(self):
-        if self.AUTH == 'NotSpecified':
-            del settings.IOS_NOTIFICATIONS_AUTHENTICATION
-        else:
-            setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', self.AUTH)
-
 
 class AuthenticationDecoratorTestAuthBasic(TestCase):
     def setUp(self):
@@ -156,12 +794,11 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
         self.user.is_staff = True
         self.user.save()
 
-        self.AUTH = getattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'NotSpecified')
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasic')
+        use_authentication(self, 'AuthBasic')
         self.device = Device.objects.create(service=self.service, token='0fd12510cfe6b0a4a89dc7369d96df956f991e66131dab63398734e8000d0029')
 
     def test_basic_authorization_request(self):
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasic')
+        use_authentication(self, 'AuthBasic')
         kwargs = {'token': self.device.token, 'service__id': self.device.service.id}
         url = reverse('ios-notifications-device', kwargs=kwargs)
         user_pass = '%s:%s' % (self.user.username, self.user_password)
@@ -170,7 +807,7 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
         self.assertEquals(resp.status_code, 200)
 
     def test_basic_authorization_request_invalid_credentials(self):
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasic')
+        use_authentication(self, 'AuthBasic')
         user_pass = '%s:%s' % (self.user.username, 'invalidpassword')
         auth_header = 'Basic %s' % user_pass.encode('base64')
         url = reverse('ios-notifications-device-create')
@@ -179,7 +816,7 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
         self.assertTrue('authentication error' in resp.content)
 
     def test_basic_authorization_missing_header(self):
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasic')
+        use_authentication(self, 'AuthBasic')
         url = reverse('ios-notifications-device-create')
         resp = self.client.get(url)
         self.assertEquals(resp.status_code, 401)
@@ -187,12 +824,12 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
 
     def test_invalid_authentication_type(self):
         from ios_notifications.decorators import InvalidAuthenticationType
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthDoesNotExist')
+        use_authentication(self, 'AuthDoesNotExist')
         url = reverse('ios-notifications-device-create')
         self.assertRaises(InvalidAuthenticationType, self.client.get, url)
 
     def test_basic_authorization_is_staff(self):
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasicIsStaff')
+        use_authentication(self, 'AuthBasicIsStaff')
         kwargs = {'token': self.device.token, 'service__id': self.device.service.id}
         url = reverse('ios-notifications-device', kwargs=kwargs)
         user_pass = '%s:%s' % (self.user.username, self.user_password)
@@ -201,8 +838,26 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
         resp = self.client.get(url, HTTP_AUTHORIZATION=auth_header)
         self.assertEquals(resp.status_code, 200)
 
+    def test_basic_authorization_is_cached(self):
+        use_authentication(self, 'AuthBasic', IOS_NOTIFICATIONS_AUTH_CACHE_SIZE=10)
+        url = reverse('ios-notifications-device', kwargs={'token': self.device.token, 'service__id': self.service.id})
+        auth_header = 'Basic %s' % ('%s:%s' % (self.user.username, self.user_password)).encode('base64')
+        self.assertEquals(self.client.get(url, HTTP_AUTHORIZATION=auth_header).status_code, 200)
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEquals(self.client.get(url, HTTP_AUTHORIZATION=auth_header).status_code, 200)
+        decorators.auth_cache.clear()
+        self.assertEquals(self.client.get(url, HTTP_AUTHORIZATION=auth_header).status_code, 401)
+
+    def test_token_authorization(self):
+        use_authentication(self, 'AuthToken', IOS_NOTIFICATIONS_API_TOKENS=['secret-token'])
+        url = reverse('ios-notifications-device', kwargs={'token': self.device.token, 'service__id': self.service.id})
+        self.assertEquals(self.client.get(url, HTTP_AUTHORIZATION='Token secret-token').status_code, 200)
+        self.assertEquals(self.client.get(url, HTTP_AUTHORIZATION='Token wrong-token').status_code, 401)
+        self.assertEquals(self.client.get(url).status_code, 401)
+
     def test_basic_authorization_is_staff_with_non_staff_user(self):
-        setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', 'AuthBasicIsStaff')
+        use_authentication(self, 'AuthBasicIsStaff')
         kwargs = {'token': self.device.token, 'service__id': self.device.service.id}
         url = reverse('ios-notifications-device', kwargs=kwargs)
         user_pass = '%s:%s' % (self.user.username, self.user_password)
@@ -213,12 +868,6 @@ class AuthenticationDecoratorTestAuthBasic(TestCase):
         self.assertEquals(resp.status_code, 401)
         self.assertTrue('authentication error' in resp.content)
 
-    def tearDown(self):
-        if self.AUTH == 'NotSpecified':
-            del settings.IOS_NOTIFICATIONS_AUTHENTICATION
-        else:
-            setattr(settings, 'IOS_NOTIFICATIONS_AUTHENTICATION', self.AUTH)
-
 
 class NotificationTest(TestCase):
     def setUp(self):
@@ -244,6 +893,7 @@ class NotificationTest(TestCase):
         self.assertIsNotNone(self.notification.last_sent_at)
 
     def tearDown(self):
+        connection_pool.close_all()
         self.test_server_proc.kill()
 
 
@@ -265,8 +915,317 @@ class ManagementCommandPushNotificationTest(TestCase):
         self.assertTrue(self.device in Device.objects.filter(last_notified_at__gt=self.started_at))
 
     def tearDown(self):
+        connection_pool.close_all()
         self.test_server_proc.kill()
 
 
+class ManagementCommandBenchmarkTest(TestCase):
+    @override_settings(IOS_NOTIFICATIONS_ERROR_RESPONSE_TIMEOUT=0.05)
+    def test_benchmark_leaves_devices_in_the_database_alone(self):
+        cert, key = generate_cert_and_pkey()
+        service = APNService.objects.create(name='service', hostname='127.0.0.1', private_key=key, certificate=cert)
+        for i in range(20):
+            Device.objects.create(token='%064x' % i, service=service)
+        devices = Device.objects.order_by('id').values_list('id', 'is_active', 'last_notified_at', 'deactivated_at')
+        before = list(devices)
+        output = StringIO()
+        management.call_command('benchmark_ios_notifications', devices='30', enhanced=True, error_every='3',
+                                track=True, feedback='0', stdout=output)
+        self.assertIn('10 errors', output.getvalue())
+        self.assertEqual(list(devices.all()), before)
+
+
+class NotificationJobTest(TestCase):
+    def setUp(self):
+        self.server = FakeAPNServer()
+        self.server.start()
+        cert, key = generate_cert_and_pkey()
+        self.service = APNService.objects.create(name='service', hostname='127.0.0.1',
+                                                 private_key=key, certificate=cert)
+        self.devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(5)]
+        self.notification = Notification.objects.create(service=self.service, message='Test message')
+        self.PORT = APNService.PORT
+        APNService.PORT = self.server.port
+
+    def test_worker_runs_queued_job(self):
+        job = self.notification.enqueue()
+        management.call_command('run_ios_notification_worker', once=True, chunk_size=2, verbosity=0)
+        self.server.stop()
+        job = NotificationJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, NotificationJob.DONE)
+        self.assertEqual(job.cursor, self.devices[-1].id)
+        self.assertEqual([token for identifier, token in self.server.received], [d.token for d in self.devices])
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 5)
+        self.assertIsNotNone(Notification.objects.get(pk=self.notification.pk).last_sent_at)
+
+    def test_job_resumes_from_cursor_with_target(self):
+        job = self.notification.enqueue(target={'id__in': [d.id for d in self.devices[:4]]})
+        NotificationJob.objects.filter(pk=job.pk).update(cursor=self.devices[1].id)
+        job = NotificationJob.claim()
+        self.assertTrue(job.run(chunk_size=10))
+        connection_pool.close_all()
+        self.server.stop()
+        self.assertEqual([token for identifier, token in self.server.received], [d.token for d in self.devices[2:4]])
+
+    def test_job_targeting_users_sends_to_each_device_once(self):
+        users = [User.objects.create(username='user%d' % i) for i in range(2)]
+        self.devices[0].users.add(*users)
+        self.devices[1].users.add(users[1])
+        self.notification.enqueue(target={'users__id__in': [user.id for user in users]})
+        job = NotificationJob.claim()
+        self.assertTrue(job.run(chunk_size=1))
+        connection_pool.close_all()
+        self.server.stop()
+        self.assertEqual([token for identifier, token in self.server.received], [d.token for d in self.devices[:2]])
+        self.assertEqual(job.get_devices().count(), 2)
+
+    @override_settings(IOS_NOTIFICATIONS_ENHANCED_FORMAT=True)
+    def test_job_resumes_before_devices_left_unsent(self):
+        self.server.invalid_tokens.add(unhexlify(self.devices[2].token))
+        job = self.notification.enqueue()
+        connect = APNService.connect
+        attempts = []
+
+        def refuse_reconnecting(service):
+            attempts.append(service)
+            return len(attempts) == 1 and connect(service)
+        APNService.connect = refuse_reconnecting
+        try:
+            self.assertFalse(NotificationJob.claim().run(chunk_size=5))
+        finally:
+            APNService.connect = connect
+        job = NotificationJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.cursor), (NotificationJob.QUEUED, self.devices[2].id))
+        self.assertTrue(NotificationJob.claim().run(chunk_size=5))
+        connection_pool.close_all()
+        self.server.stop()
+        self.assertEqual([token for identifier, token in self.server.received], [d.token for d in self.devices])
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 4)
+
+    def test_device_stream_skips_repeated_rows_of_a_device(self):
+        users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        self.devices[0].users.add(*users)
+        self.devices[2].users.add(*users[:2])
+        devices = self.service.device_set.filter(users__id__in=[user.id for user in users])
+        self.assertEqual(list(DeviceStream(devices, chunk_size=4)), [(d.id, d.token) for d in self.devices[0:3:2]])
+
+    def test_expired_claim_is_run_again(self):
+        job = self.notification.enqueue()
+        self.assertEqual(NotificationJob.claim().pk, job.pk)
+        self.assertIsNone(NotificationJob.claim())
+        NotificationJob.objects.filter(pk=job.pk).update(claimed_at=datetime.datetime.now() - datetime.timedelta(hours=1))
+        job = NotificationJob.claim()
+        self.assertEqual(job.attempts, 2)
+
+    def test_scheduler_queues_and_sends_due_notifications(self):
+        now = datetime.datetime.now()
+        due = Notification.objects.create(service=self.service, message='Due', send_at=now - datetime.timedelta(minutes=1))
+        later = Notification.objects.create(service=self.service, message='Later', send_at=now + datetime.timedelta(hours=1))
+        management.call_command('run_ios_notification_scheduler', once=True, verbosity=0)
+        # The queued notification is left out by the query which finds due notifications.
+        with self.assertNumQueries(1):
+            self.assertEqual(NotificationJob.enqueue_due(), [])
+        connection_pool.close_all()
+        self.server.stop()
+        self.assertEqual(list(NotificationJob.objects.values_list('notification', 'status')), [(due.pk, NotificationJob.DONE)])
+        self.assertIsNotNone(Notification.objects.get(pk=due.pk).last_sent_at)
+        self.assertIsNone(Notification.objects.get(pk=later.pk).last_sent_at)
+        self.assertEqual(len(self.server.received), 5)
+
+    def test_rate_limit_paces_broadcast(self):
+        self.service.rate_limit = 20
+        self.service.save()
+        for i in range(5, 9):
+            Device.objects.create(token=str(i) * 64, service=self.service)
+        started = time.time()
+        result = self.service.push_notification_to_devices(self.notification, workers=2)
+        elapsed = time.time() - started
+        connection_pool.close_all()
+        self.server.stop()
+        self.assertEqual(result.frames_written, 9)
+        self.assertEqual(self.server.frames, 9)
+        # The bucket allows a burst of 2, so the other 7 frames are paced at 20 a second.
+        self.assertTrue(elapsed >= 0.3)
+
+    def test_spread_limits_rate_to_devices_over_time(self):
+        self.notification.spread = 10
+        throttle = self.service.get_throttle(self.notification, self.service.device_set.all())
+        self.assertEqual(throttle.rate, 0.5)
+        self.assertIsNone(self.service.get_throttle(Notification(service=self.service), self.service.device_set.all()))
+
+    def tearDown(self):
+        APNService.PORT = self.PORT
+        connection_pool.close_all()
+        self.server.stop()
+
+
+class TransportTest(TestCase):
+    def setUp(self):
+        cert, key = generate_cert_and_pkey()
+        self.service = APNService.objects.create(name='load-test', hostname='gateway.push.apple.com', transport='null',
+                                                 certificate=cert, private_key=key)
+        self.devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(6)]
+        self.notification = Notification.objects.create(service=self.service, message='Test message')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def read_capture(self):
+        data = open(self.path, 'rb').read()
+        frames = FrameBuilder(self.service.get_payload(self.notification), enhanced=True)
+        tokens = [data[offset + 11:offset + 43].encode('hex') for offset in range(0, len(data), frames.size)]
+        return len(data) % frames.size, tokens
+
+    def test_null_transport_runs_whole_pipeline(self):
+        result = self.service.push_notification_to_devices(self.notification, enhanced=True, workers=2)
+        connection_pool.close_all()
+        self.assertEqual(result.frames_written, 6)
+        self.assertTrue(result.frames_per_second > 0)
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 6)
+        self.assertIsNotNone(Notification.objects.get(pk=self.notification.pk).last_sent_at)
+
+    def test_file_transport_captures_frames(self):
+        self.service.transport = 'file'
+        self.service.save()
+        use_settings = override_settings(IOS_NOTIFICATIONS_CAPTURE_PATH=self.path)
+        use_settings.enable()
+        self.addCleanup(use_settings.disable)
+        result = self.service.push_notification_to_devices(self.notification, enhanced=True)
+        connection_pool.close_all()
+        loop = PushLoop()
+        loop.add(self.service, self.notification, self.service.device_set.filter(pk=self.devices[0].pk), enhanced=True)
+        self.assertEqual(loop.run()[0].frames_written, 1)
+        self.assertEqual(result.bytes_written + result.bytes_written // 6, os.path.getsize(self.path))
+        self.assertEqual(self.read_capture(), (0, [d.token for d in self.devices] + [self.devices[0].token]))
+
+    def test_push_command_with_null_transport(self):
+        management.call_command('push_ios_notification', message='Load test', service=self.service.id, verbosity=0)
+        connection_pool.close_all()
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 6)
+
+
+class DispatchTest(TestCase):
+    def setUp(self):
+        self.servers = [FakeAPNServer(), FakeAPNServer()]
+        self.services = []
+        for i, server in enumerate(self.servers):
+            server.start()
+            cert, key = generate_cert_and_pkey()
+            service = APNService.objects.create(name='app-%d' % i, hostname='127.0.0.1', certificate=cert, private_key=key)
+            service.PORT = server.port
+            self.services.append(service)
+        self.users = [User.objects.create(username='user%d' % i) for i in range(2)]
+
+    def test_dispatch_sends_to_devices_of_every_service(self):
+        first = [Device.objects.create(token=str(i) * 64, service=self.services[0]) for i in range(3)]
+        second = [Device.objects.create(token=str(i) * 64, service=self.services[1]) for i in range(2)]
+        for device in first[:2] + second:
+            device.users.add(*self.users)
+        first[2].users.add(self.users[1])
+        Device.objects.create(token='9' * 64, service=self.services[1])
+        notification = Notification.objects.create(service=self.services[0], message='Hello')
+
+        # dispatch() loads the services again, so connect them to the fake servers through the pool.
+        for service in self.services:
+            self.assertTrue(connection_pool.acquire(service))
+            connection_pool.release(service)
+        result = dispatch(notification, user_ids=[user.id for user in self.users])
+        connection_pool.close_all()
+        for server in self.servers:
+            server.stop()
+
+        self.assertEqual(dict((service.pk, r.frames_written) for service, r in result.items()),
+                         {self.services[0].pk: 3, self.services[1].pk: 2})
+        self.assertEqual(result.total.frames_written, 5)
+        self.assertEqual(sorted(token for identifier, token in self.servers[0].received), [d.token for d in first])
+        self.assertEqual(sorted(token for identifier, token in self.servers[1].received), [d.token for d in second])
+        copy = Notification.objects.get(service=self.services[1])
+        self.assertEqual((copy.message, copy.badge, copy.sound), ('Hello', 1, 'default'))
+        self.assertIsNotNone(copy.last_sent_at)
+        self.assertIsNotNone(Notification.objects.get(pk=notification.pk).last_sent_at)
+        self.assertEqual(Device.objects.filter(last_notified_at__isnull=False).count(), 5)
+
+    def test_dispatch_reuses_its_copy_of_a_notification(self):
+        scheduled = Notification.objects.create(service=self.services[1], message='Hello', badge=None,
+                                                send_at=datetime.datetime.now() + datetime.timedelta(hours=1))
+        copy = copy_notification(Notification(message='Hello', badge=None), self.services[1])
+        self.assertNotEqual(copy.pk, scheduled.pk)
+        self.assertEqual(copy_notification(Notification(message='Hello', badge=None), self.services[1]).pk, copy.pk)
+        self.assertNotEqual(copy_notification(Notification(message='Hello'), self.services[1]).pk, copy.pk)
+        self.assertNotEqual(copy_notification(Notification(message='Hello', badge=None), self.services[0]).pk, copy.pk)
+        self.assertEqual(Notification.objects.count(), 4)
+
+    def tearDown(self):
+        connection_pool.close_all()
+        for server in self.servers:
+            server.stop()
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.bucket = TokenBucket(10, capacity=5, clock=lambda: self.now)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_take_refills_at_rate_up_to_capacity(self):
+        self.assertEqual(self.bucket.take(8), 5)
+        self.assertEqual(self.bucket.take(1), 0)
+        self.assertAlmostEqual(self.bucket.delay(2), 0.2)
+        self.now += 0.3
+        self.assertEqual(self.bucket.take(8), 3)
+        self.now += 10
+        self.assertEqual(self.bucket.available(), 5)
+
+    def test_consume_waits_for_tokens(self):
+        self.bucket.consume(9, self.sleep)
+        self.assertAlmostEqual(sum(self.sleeps), 0.4)
+        other = TokenBucket(100, clock=lambda: self.now)
+        throttle = Throttle(self.bucket, other)
+        self.assertEqual(throttle.rate, 10)
+        self.assertEqual(throttle.acquire(3, self.sleep), 1)
+        self.assertEqual(throttle.take(3), 0)
+
+
+class FeedbackServiceTest(TestCase):
+    def setUp(self):
+        cert, key = generate_cert_and_pkey()
+        self.service = APNService.objects.create(name='test-service', hostname='127.0.0.1',
+                                                 certificate=cert, private_key=key)
+        self.feedback = FeedbackService.objects.create(name='test-feedback', hostname='127.0.0.1',
+                                                       apn_service=self.service)
+        self.devices = [Device.objects.create(token=str(i) * 64, service=self.service) for i in range(5)]
+        self.PORT = FeedbackService.PORT
+
+    def test_deactivates_devices_in_batches(self):
+        now = time.time()
+        earlier = datetime.datetime.now() - datetime.timedelta(hours=1)
+        Device.objects.filter(pk=self.devices[2].pk).update(last_registered_at=datetime.datetime.now() + datetime.timedelta(hours=1))
+        Device.objects.all().update(added_at=earlier)
+        server = FakeFeedbackServer([(now, d.token) for d in self.devices[:4]])
+        FeedbackService.PORT = server.port
+        server.start()
+        self.assertTrue(self.feedback.connect())
+        self.assertEqual(list(self.feedback.deactivate_devices(batch_size=2)), [2, 1])
+        server.join(1)
+        self.assertEqual(list(Device.objects.filter(is_active=True).order_by('id')), [self.devices[2], self.devices[4]])
+        self.assertIsNone(self.feedback.connection)
+
+    def test_call_handles_dropped_connection(self):
+        Device.objects.all().update(added_at=datetime.datetime.now() - datetime.timedelta(hours=1))
+        server = FakeFeedbackServer([(time.time(), d.token) for d in self.devices], chunk_size=7, disconnect=True)
+        FeedbackService.PORT = server.port
+        server.start()
+        self.assertEqual(self.feedback.call(), 5)
+        server.join(1)
+        self.assertFalse(Device.objects.filter(is_active=True).exists())
+
+    def tearDown(self):
+        FeedbackService.PORT = self.PORT
+
+
 class ManagementCommandCallFeedbackService(TestCase):
     pass
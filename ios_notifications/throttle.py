@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Limits an operation to `rate` times a second on average, allowing bursts of up
+    to `capacity`, which defaults to a tenth of a second's worth.
+
+    The bucket is thread safe, so one bucket can pace every connection of a service.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = capacity if capacity is not None else max(self.rate / 10, 1.0)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """
+        The number of whole tokens which can be taken without waiting.
+        """
+        with self._lock:
+            self._refill()
+            return int(self.tokens)
+
+    def take(self, count):
+        """
+        Takes up to `count` tokens without waiting.
+
+        returns the number of tokens taken, which may be 0.
+        """
+        with self._lock:
+            self._refill()
+            taken = min(count, int(self.tokens))
+            self.tokens -= taken
+            return taken
+
+    def delay(self, count=1):
+        """
+        The number of seconds until `count` tokens will be available.
+        """
+        with self._lock:
+            self._refill()
+            return max(count - self.tokens, 0) / self.rate
+
+    def acquire(self, count, sleep=time.sleep):
+        """
+        Waits until at least one token is available and takes up to `count` tokens.
+
+        returns the number of tokens taken.
+        """
+        while True:
+            taken = self.take(count)
+            if taken:
+                return taken
+            sleep(self.delay())
+
+    def consume(self, count, sleep=time.sleep):
+        """
+        Waits until all `count` tokens have been taken.
+        """
+        while count > 0:
+            count -= self.acquire(count, sleep)
+
+
+class Throttle(object):
+    """
+    Paces sending by every one of several token buckets, for example a bucket
+    shared by all the connections of a service and one spreading a broadcast out over time.
+    """
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+    @property
+    def rate(self):
+        return min(bucket.rate for bucket in self.buckets)
+
+    def take(self, count):
+        """
+        Takes up to `count` tokens from every bucket without waiting.
+        """
+        count = min([count] + [bucket.available() for bucket in self.buckets])
+        if count:
+            for bucket in self.buckets:
+                bucket.consume(count)
+        return count
+
+    def delay(self, count=1):
+        return max(bucket.delay(count) for bucket in self.buckets)
+
+    def acquire(self, count, sleep=time.sleep):
+        """
+        Waits until at least one token is available from every bucket and takes up to `count`.
+        """
+        count = self.buckets[0].acquire(count, sleep)
+        for bucket in self.buckets[1:]:
+            bucket.consume(count, sleep)
+        return count
+
+
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_bucket(service):
+    """
+    The process wide token bucket enforcing the `rate_limit` of a service.
+    A new bucket is made if the rate limit has been changed.
+    """
+    key = (service.__class__.__name__, service.pk)
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None or bucket.rate != service.rate_limit:
+            bucket = _buckets[key] = TokenBucket(service.rate_limit)
+        return bucket
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import atexit
+import mmap
+import os
+import socket
+import tempfile
+import threading
+
+from django.conf import settings
+
+import OpenSSL
+
+
+class NullConnection(object):
+    """
+    Stands in for the SSL connection to the APN service when load testing.
+
+    Everything written to it is thrown away and Apple never sends an error response,
+    so a push runs through streaming devices, packing frames, buffering and bookkeeping
+    exactly as it would against Apple. A socket pair provides a file descriptor so the
+    connection can be used with `select` like a real one.
+    """
+    def __init__(self):
+        self._sock, self._peer = socket.socketpair()
+        self._blocking = True
+        self.closed = False
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def setblocking(self, flag):
+        self._blocking = bool(flag)
+
+    def getsockopt(self, *args):
+        return 0
+
+    def set_connect_state(self):
+        pass
+
+    def do_handshake(self):
+        pass
+
+    def get_session(self):
+        return None
+
+    def write(self, data):
+        pass
+
+    def send(self, data):
+        if self.closed:
+            raise OpenSSL.SSL.SysCallError(-1, 'Unexpected EOF')
+        self.write(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv(self, bufsiz):
+        # There is never anything to read. A blocking read would wait
+        # forever, so it sees the end of the stream instead.
+        if self._blocking:
+            raise OpenSSL.SSL.ZeroReturnError()
+        raise OpenSSL.SSL.WantReadError()
+
+    def pending(self):
+        return 0
+
+    def shutdown(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._sock.close()
+            self._peer.close()
+
+
+class CaptureFile(object):
+    """
+    Appends data to a file through a memory map which is grown `chunk_size` bytes
+    at a time. Shared by every connection writing to the same path, so writes are locked.
+    """
+    def __init__(self, path, chunk_size=16 * 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        open(path, 'ab').close()
+        self.file = open(path, 'r+b')
+        self.file.seek(0, os.SEEK_END)
+        self.length = self.file.tell()
+        self.map = None
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            end = self.length + len(data)
+            if self.map is None or end > len(self.map):
+                self._grow(end)
+            self.map[self.length:end] = data
+            self.length = end
+
+    def _grow(self, size):
+        if self.map is not None:
+            self.map.close()
+        size = (size // self.chunk_size + 1) * self.chunk_size
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def flush(self):
+        """
+        Unmaps the file and trims the space reserved for further writes.
+        """
+        with self._lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+            self.file.truncate(self.length)
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+_captures = {}
+_lock = threading.Lock()
+
+
+def get_capture(path):
+    with _lock:
+        if path not in _captures:
+            _captures[path] = CaptureFile(path)
+        return _captures[path]
+
+
+def close_captures():
+    with _lock:
+        captures = _captures.values()
+        _captures.clear()
+    for capture in captures:
+        capture.close()
+
+atexit.register(close_captures)
+
+
+def get_capture_path(service):
+    """
+    The file frames sent by `service` are captured in, set with IOS_NOTIFICATIONS_CAPTURE_PATH.
+    `%(id)s` and `%(name)s` are replaced with the service's id and name.
+    """
+    path = getattr(settings, 'IOS_NOTIFICATIONS_CAPTURE_PATH',
+                   os.path.join(tempfile.gettempdir(), 'ios_notifications_%(id)s.capture'))
+    return path % {'id': service.pk, 'name': service.name}
+
+
+class FileConnection(NullConnection):
+    """
+    A NullConnection which appends everything written to it to a capture file,
+    byte for byte as it would have been sent to Apple.
+    """
+    def __init__(self, path):
+        super(FileConnection, self).__init__()
+        self.capture = get_capture(path)
+
+    def write(self, data):
+        self.capture.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.capture.flush()
+        super(FileConnection, self).close()
@@ -5,5 +5,6 @@ from ios_notifications.api import routes
 
 urlpatterns = patterns('',
     url(r'^device/$', routes.device, name='ios-notifications-device-create'),
+    url(r'^device/bulk/$', routes.bulk_device, name='ios-notifications-device-bulk'),
     url(r'^device/(?P<token>\w+)/(?P<service__id>\d+)/$', routes.device, name='ios-notifications-device'),
 )